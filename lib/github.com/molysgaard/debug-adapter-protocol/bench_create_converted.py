@@ -0,0 +1,59 @@
+import gc
+import sys
+import time
+
+import jsonschema_test
+
+# Synthetic schemas shaped like debugProtocol.json: every definition extends a
+# parent through `allOf` (like XxxRequest extends Request) and has properties
+# that `$ref` other definitions. Definitions are listed children first, which
+# is the worst order for resolving `allOf` parents. Conversion is timed with
+# the cyclic garbage collector running, as the generator runs, and with it
+# disabled. Most of the rise in time per definition with the size of the
+# schema is the collector passing over the growing set of converted nodes.
+
+def synthetic_definitions(n, fanout=8):
+    definitions = {}
+    for i in reversed(range(n)):
+        props = {
+            'field{}'.format(i): {'type': 'integer'},
+            'name': {'type': 'string'},
+        }
+        if i > 0:
+            props['ref{}'.format(i)] = {'$ref': '#/definitions/Def{}'.format((i * 7919) % n)}
+            props['refs{}'.format(i)] = {'type': 'array', 'items': {'$ref': '#/definitions/Def{}'.format(i // 2)}}
+            definitions['Def{}'.format(i)] = {'allOf': [
+                {'$ref': '#/definitions/Def{}'.format((i - 1) // fanout)},
+                {'type': 'object', 'description': 'Definition {}'.format(i), 'properties': props},
+            ]}
+        else:
+            definitions['Def0'] = {'type': 'object', 'properties': props, 'required': ['name']}
+    return definitions
+
+def bench(n, collect, repeat=3):
+    best = None
+    for _i in range(repeat):
+        definitions = synthetic_definitions(n)
+        gc.collect()
+        if not collect:
+            gc.disable()
+        try:
+            start = time.perf_counter()
+            converted = jsonschema_test.create_converted(definitions)
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        assert all('Def{}'.format(i) in converted for i in range(n))
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(argv):
+    sizes = [int(a) for a in argv[1:]] or [1000, 10000, 50000]
+    print('{:>8} {:>10} {:>12} {:>10} {:>12}'.format('defs', 'seconds', 'us/def', 'no gc s', 'no gc us/def'))
+    for n in sizes:
+        t = bench(n, True)
+        u = bench(n, False)
+        print('{:>8} {:>10.3f} {:>12.2f} {:>10.3f} {:>12.2f}'.format(n, t, t / n * 1e6, u, u / n * 1e6))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+# Throughput of the adapter's stdin framing: the old TextIO loop against the
+# Framing reader, over many small messages and a few multi-megabyte ones.
+# Needs the framing-bench binary (make framing-bench).
+
+def frame(payload):
+    return b'Content-Length: ' + str(len(payload)).encode('ascii') + b'\r\n\r\n' + payload
+
+def small_messages(n):
+    out = []
+    for i in range(n):
+        payload = '{{"seq":{},"type":"request","command":"threads"}}'.format(i).encode('ascii')
+        out.append(frame(payload))
+    return b''.join(out)
+
+def large_messages(n, size):
+    out = []
+    for i in range(n):
+        body = b'x' * (size - 64)
+        payload = b'{"seq":' + str(i).encode('ascii') + b',"type":"request","command":"evaluate","arguments":{"expression":"' + body + b'"}}'
+        out.append(frame(payload))
+    return b''.join(out)
+
+def run(binary, mode, path):
+    with open(path, 'rb') as f:
+        out = subprocess.run([binary, mode], stdin=f, stdout=subprocess.PIPE, check=True).stdout
+    _mode, n, nbytes, secs = out.decode('ascii').split()
+    return int(n), int(nbytes), float(secs)
+
+def main(argv):
+    binary = argv[1] if len(argv) > 1 else './framing-bench'
+    workloads = [
+        ('200k small', small_messages(200000)),
+        ('8 x 4MB', large_messages(8, 4 * 1024 * 1024)),
+    ]
+    print('{:<12} {:<8} {:>8} {:>10} {:>12} {:>10}'.format('workload', 'reader', 'msgs', 'seconds', 'msgs/s', 'MB/s'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, data in workloads:
+            path = os.path.join(tmp, 'input')
+            with open(path, 'wb') as f:
+                f.write(data)
+            for mode in ['textio', 'framing']:
+                n, nbytes, secs = run(binary, mode, path)
+                secs = max(secs, 1e-9)
+                print('{:<12} {:<8} {:>8} {:>10.3f} {:>12.0f} {:>10.1f}'.format(name, mode, n, secs, n / secs, nbytes / secs / 1e6))
+
+if __name__ == '__main__':
+    main(sys.argv)
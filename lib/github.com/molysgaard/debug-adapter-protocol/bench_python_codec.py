@@ -0,0 +1,170 @@
+import base64
+import dataclasses
+import io
+import json
+import sys
+import time
+import types
+import typing
+
+import jsonschema_test as gen
+import python_codec
+
+# Decoding and encoding throughput of the generated Python codec against plain
+# dicts and against dataclasses filled in by a reflective decoder, the way
+# dataclass based libraries decode: walking the fields of the class and the
+# type of each field for every message. All three start from the dicts
+# json.loads gives, parsing is the same for each and is left out.
+
+def codec_module(schema):
+    out = io.StringIO()
+    python_codec.generate(schema, out)
+    module = types.ModuleType('dap_codec')
+    exec(compile(out.getvalue(), 'dap_codec.py', 'exec'), module.__dict__)
+    return module
+
+class Reflective(object):
+    # a dataclass per record of the model, with the JSON name and the model
+    # type of each field in its metadata
+    def __init__(self, model):
+        self.model = model
+        self.backend = python_codec.Backend(model)
+        self.classes = {}
+
+    def record(self, t):
+        return self.backend.record(t)
+
+    def dataclass(self, rec):
+        if id(rec) not in self.classes:
+            fields = [(python_codec.attr_name(k), typing.Any,
+                       dataclasses.field(default=None, metadata={'json': python_codec.json_name(k), 'type': v}))
+                      for k, v in rec.props.items()]
+            self.classes[id(rec)] = dataclasses.make_dataclass(self.backend.classes[id(rec)], fields, slots=True)
+        return self.classes[id(rec)]
+
+    def decode(self, t, v):
+        if isinstance(t, gen.Option):
+            return None if v is None else self.decode(t.o, v)
+        rec = self.record(t)
+        if rec is not None:
+            cls = self.dataclass(rec)
+            return cls(**dict((f.name, self.decode(f.metadata['type'], v.get(f.metadata['json'])))
+                              for f in dataclasses.fields(cls)))
+        elif isinstance(t, gen.Array):
+            return [self.decode(t.e, x) for x in v]
+        elif isinstance(t, gen.StringMap):
+            return dict((k, self.decode(t.e, x)) for k, x in v.items())
+        elif isinstance(t, gen.Bytes):
+            return base64.b64decode(v)
+        return v
+
+    def encode(self, t, v):
+        if isinstance(t, gen.Option):
+            return self.encode(t.o, v)
+        if self.record(t) is not None:
+            out = {}
+            for f in dataclasses.fields(v):
+                x = getattr(v, f.name)
+                if x is not None:
+                    out[f.metadata['json']] = self.encode(f.metadata['type'], x)
+            return out
+        elif isinstance(t, gen.Array):
+            return [self.encode(t.e, x) for x in v]
+        elif isinstance(t, gen.StringMap):
+            return dict((k, self.encode(t.e, x)) for k, x in v.items())
+        elif isinstance(t, gen.Bytes):
+            return base64.b64encode(v).decode('ascii')
+        return v
+
+def stack_trace(frames):
+    return {'seq': 7, 'type': 'response', 'request_seq': 6, 'success': True, 'command': 'stackTrace',
+            'body': {'totalFrames': frames, 'stackFrames': [
+                {'id': i, 'name': 'f{}'.format(i), 'line': 10 + i, 'column': 1, 'presentationHint': 'normal',
+                 'source': {'name': 'a.sml', 'path': '/src/a.sml', 'checksums': [{'algorithm': 'MD5', 'checksum': '0' * 32}]}}
+                for i in range(frames)]}}
+
+def variables(n):
+    return {'seq': 9, 'type': 'response', 'request_seq': 8, 'success': True, 'command': 'variables',
+            'body': {'variables': [
+                {'name': 'x{}'.format(i), 'value': str(i), 'type': 'int', 'variablesReference': 0,
+                 'presentationHint': {'kind': 'property', 'attributes': ['readOnly']}}
+                for i in range(n)]}}
+
+def output_event():
+    return {'seq': 3, 'type': 'event', 'event': 'output',
+            'body': {'category': 'stdout', 'output': 'hello world\n', 'line': 4}}
+
+def set_breakpoints():
+    return {'seq': 2, 'type': 'request', 'command': 'setBreakpoints',
+            'arguments': {'source': {'path': '/src/a.sml'}, 'breakpoints': [{'line': l} for l in range(5)],
+                          'sourceModified': False}}
+
+def dict_access(d):
+    # what a client reads of each message
+    if d['type'] == 'response':
+        body = d['body']
+        return len(body.get('stackFrames', body.get('variables', ())))
+    elif d['type'] == 'event':
+        return len(d['body']['output'])
+    return len(d['arguments']['breakpoints'])
+
+def object_access(o):
+    if o.type_ == 'response':
+        body = o.body
+        return len(getattr(body, 'stackFrames', None) or getattr(body, 'variables', None) or ())
+    elif o.type_ == 'event':
+        return len(o.body.output)
+    return len(o.arguments.breakpoints)
+
+def best_of(f, repeat=5):
+    best = None
+    for _i in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def message_type(model, d):
+    if d['type'] == 'request':
+        return model.commands()[gen.upper_first(d['command'])]['req']
+    elif d['type'] == 'response':
+        return model.commands()[gen.upper_first(d['command'])]['resp']
+    return model.msgs['events'][d['event']]
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 2000
+    with open('debugProtocol.json') as f:
+        schema = json.load(f)
+    model = gen.Model(schema)
+    codec = codec_module(schema)
+    reflective = Reflective(model)
+
+    workloads = [
+        ('stackTrace x20', stack_trace(20)),
+        ('variables x100', variables(100)),
+        ('output event', output_event()),
+        ('setBreakpoints', set_breakpoints()),
+    ]
+    print('{:<16} {:<10} {:>12} {:>12}'.format('message', 'decoder', 'decode/s', 'encode/s'))
+    for name, msg in workloads:
+        msgs = [json.loads(json.dumps(msg)) for _i in range(n)]
+        t = message_type(model, msg)
+
+        objs = [codec.from_message(d) for d in msgs]
+        dcs = [reflective.decode(t, d) for d in msgs]
+        assert objs[0].to_dict() == msg and reflective.encode(t, dcs[0]) == msg
+
+        results = [
+            # dicts are already what json.dumps takes
+            ('dict', best_of(lambda: [dict_access(d) for d in msgs]), None),
+            ('slots', best_of(lambda: [object_access(codec.from_message(d)) for d in msgs]),
+                      best_of(lambda: [len(o.to_dict()) for o in objs])),
+            ('dataclass', best_of(lambda: [object_access(reflective.decode(t, d)) for d in msgs]),
+                          best_of(lambda: [len(reflective.encode(t, o)) for o in dcs])),
+        ]
+        for decoder, dec, enc in results:
+            print('{:<16} {:<10} {:>12.0f} {:>12}'.format(name, decoder, n / dec, '-' if enc is None else '{:.0f}'.format(n / enc)))
+
+if __name__ == '__main__':
+    main(sys.argv)
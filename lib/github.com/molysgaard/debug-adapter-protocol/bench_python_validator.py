@@ -0,0 +1,84 @@
+import io
+import json
+import sys
+import types
+
+import bench_python_codec
+import python_validator
+
+try:
+    import jsonschema
+except ImportError:
+    jsonschema = None
+
+# Messages validated per second by the generated validator, fail-fast and
+# collecting every error, and by the jsonschema library when it is installed.
+# The session mix is the traffic of one load_test round: a stackTrace, scopes,
+# variables and evaluate request with their responses and an output event.
+
+def validator_module(schema):
+    out = io.StringIO()
+    python_validator.generate(schema, out)
+    module = types.ModuleType('dap_validator')
+    exec(compile(out.getvalue(), 'dap_validator.py', 'exec'), module.__dict__)
+    return module
+
+def request(seq, command, arguments):
+    return {'seq': seq, 'type': 'request', 'command': command, 'arguments': arguments}
+
+def response(seq, command, body):
+    return {'seq': seq + 1, 'type': 'response', 'request_seq': seq, 'success': True, 'command': command, 'body': body}
+
+def session_mix():
+    return [
+        request(1, 'stackTrace', {'threadId': 1, 'levels': 20}),
+        bench_python_codec.stack_trace(20),
+        request(3, 'scopes', {'frameId': 1}),
+        response(3, 'scopes', {'scopes': [{'name': 'Locals', 'variablesReference': 1, 'expensive': False}]}),
+        request(5, 'variables', {'variablesReference': 1, 'count': 100}),
+        bench_python_codec.variables(20),
+        request(7, 'evaluate', {'expression': 'x + 1', 'frameId': 1}),
+        response(7, 'evaluate', {'result': '2', 'variablesReference': 0}),
+        bench_python_codec.output_event(),
+    ]
+
+def library_validator(schema):
+    # the definition a message is checked against is picked the same way the
+    # generated check_message does
+    validators = {}
+    def validate(msg):
+        if msg['type'] == 'event':
+            name = msg['event'][0].upper() + msg['event'][1:] + 'Event'
+        else:
+            name = msg['command'][0].upper() + msg['command'][1:] + msg['type'].capitalize()
+        if name not in validators:
+            validators[name] = jsonschema.Draft4Validator(dict(schema, **{'$ref': '#/definitions/' + name}))
+        validators[name].validate(msg)
+    return validate
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 2000
+    with open('debugProtocol.json') as f:
+        schema = json.load(f)
+    v = validator_module(schema)
+
+    workloads = [
+        ('stackTrace x20', [bench_python_codec.stack_trace(20)]),
+        ('output event', [bench_python_codec.output_event()]),
+        ('setBreakpoints', [bench_python_codec.set_breakpoints()]),
+        ('session mix', session_mix()),
+    ]
+    validators = [('fail-fast', v.validate), ('collect-all', v.validate_all)]
+    if jsonschema is not None:
+        validators.append(('jsonschema', library_validator(schema)))
+    print('{:<16} {:<12} {:>12}'.format('message', 'validator', 'msgs/s'))
+    for name, kinds in workloads:
+        for m in kinds:
+            assert v.validate_all(m) == []
+        msgs = [json.loads(json.dumps(m)) for _i in range(max(1, n // len(kinds))) for m in kinds]
+        for validator, f in validators:
+            t = bench_python_codec.best_of(lambda: [f(m) for m in msgs])
+            print('{:<16} {:<12} {:>12.0f}'.format(name, validator, len(msgs) / t))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,343 @@
+import argparse
+import asyncio
+import json
+import mmap
+import os
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import load_test
+
+# Records debug sessions and replays them against the adapter.
+#
+# record sits between the client and the adapter and appends every framed
+# message, in either direction, to a capture. A capture is two append-only
+# files: the payloads one after another, and next to it (.idx) an index of
+# fixed-size entries with the offset, length, time and direction of each
+# message, the session it belongs to and what it is about (type, seq,
+# request_seq, command or event). Every record run appends a new session, the
+# sessions of a capture are replayed one after another, each against an
+# adapter process of its own.
+# Entry N is at a fixed offset, so show and replay can go to message N or pick
+# the messages of one command through the index alone, mmapped, without
+# reading any payload they do not use.
+#
+# replay sends the recorded requests to an adapter, at the recorded pace or
+# each as soon as the one before is answered, and reports where its
+# responses differ from the recorded ones.
+
+data_magic = b'DAPCAP1\n'
+index_magic = b'DAPIDX2\n'
+# offset, length, direction, kind, session, time, seq, request_seq, command or event
+command_size = 32
+entry_format = struct.Struct('<QIBBHdqq{}s'.format(command_size))
+
+TO_ADAPTER = 0
+FROM_ADAPTER = 1
+kinds = ['other', 'request', 'response', 'event']
+
+class Entry(object):
+    __slots__ = ('n', 'offset', 'length', 'direction', 'kind', 'session', 'time', 'seq', 'request_seq', 'command')
+
+    def __init__(self, n, fields):
+        self.n = n
+        (self.offset, self.length, self.direction, kind, self.session, self.time,
+         self.seq, self.request_seq, command) = fields
+        self.kind = kinds[kind] if kind < len(kinds) else 'other'
+        self.command = command.rstrip(b'\0').decode('utf-8', 'replace')
+
+def describe(payload):
+    # the index fields of a message, messages that are not JSON objects are
+    # recorded as other
+    try:
+        msg = json.loads(payload)
+    except ValueError:
+        msg = None
+    if not isinstance(msg, dict):
+        return 0, 0, 0, b''
+    kind = kinds.index(msg['type']) if msg.get('type') in kinds else 0
+    name = msg.get('event' if kind == 3 else 'command')
+    name = name.encode('utf-8')[:command_size] if isinstance(name, str) else b''
+    def integer(k):
+        v = msg.get(k)
+        return v if isinstance(v, int) and -2**63 <= v < 2**63 else 0
+    return kind, integer('seq'), integer('request_seq'), name
+
+class CaptureWriter(object):
+    # Appends a new session to a new or existing capture. The payload is
+    # written before its index entry, a capture cut short only loses messages
+    # nothing points to.
+    def __init__(self, path):
+        self.session = 0
+        if os.path.exists(path + '.idx') and os.path.getsize(path + '.idx') > len(index_magic):
+            capture = Capture(path)
+            try:
+                if len(capture):
+                    self.session = capture.entry(len(capture) - 1).session + 1
+            finally:
+                capture.close()
+        self.data = open(path, 'ab')
+        self.index = open(path + '.idx', 'ab')
+        if self.data.tell() == 0:
+            self.data.write(data_magic)
+        if self.index.tell() == 0:
+            self.index.write(index_magic)
+        # a torn last entry from an earlier run would shift every new one
+        self.index.truncate(len(index_magic) + (self.index.tell() - len(index_magic)) // entry_format.size * entry_format.size)
+        self.index.seek(0, os.SEEK_END)
+        self.lock = threading.Lock()
+
+    def add(self, direction, payload, t=None):
+        kind, seq, request_seq, name = describe(payload)
+        with self.lock:
+            offset = self.data.tell()
+            self.data.write(payload)
+            self.data.flush()
+            self.index.write(entry_format.pack(offset, len(payload), direction, kind, self.session,
+                                               time.time() if t is None else t, seq, request_seq, name))
+            self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+class Capture(object):
+    def __init__(self, path):
+        self.data_file = open(path, 'rb')
+        self.index_file = open(path + '.idx', 'rb')
+        self.data = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(data_magic)] != data_magic or self.index[:len(index_magic)] != index_magic:
+            raise ValueError('{} is not a capture'.format(path))
+        # a torn last entry is left out
+        self.count = (len(self.index) - len(index_magic)) // entry_format.size
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, n):
+        if not 0 <= n < self.count:
+            raise IndexError(n)
+        return Entry(n, entry_format.unpack_from(self.index, len(index_magic) + n * entry_format.size))
+
+    def payload(self, e):
+        return self.data[e.offset:e.offset + e.length]
+
+    def message(self, e):
+        return json.loads(self.payload(e))
+
+    def select(self, start=0, count=None, command=None, direction=None, session=None):
+        # entries from message start on, of command (or event) and session
+        # only when given
+        end = self.count if count is None else min(self.count, start + count)
+        for n in range(start, end):
+            e = self.entry(n)
+            if ((command is None or e.command == command) and (direction is None or e.direction == direction)
+                    and (session is None or e.session == session)):
+                yield e
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+        self.data_file.close()
+        self.index_file.close()
+
+def read_frame(f):
+    # the payload of the next framed message, None at the end of the input
+    length = None
+    while True:
+        line = f.readline()
+        if not line:
+            return None
+        line = line.rstrip(b'\r\n')
+        if not line:
+            if length is None:
+                continue
+            break
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    payload = f.read(length)
+    return payload if len(payload) == length else None
+
+def frame(payload):
+    return b'Content-Length: ' + str(len(payload)).encode('ascii') + b'\r\n\r\n' + payload
+
+def pump(src, dst, writer, direction):
+    try:
+        while True:
+            payload = read_frame(src)
+            if payload is None:
+                break
+            writer.add(direction, payload)
+            dst.write(frame(payload))
+            dst.flush()
+    except (BrokenPipeError, ValueError):
+        pass
+    finally:
+        try:
+            dst.close()
+        except BrokenPipeError:
+            pass
+
+def record(path, argv):
+    writer = CaptureWriter(path)
+    proc = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    to_adapter = threading.Thread(target=pump, args=(sys.stdin.buffer, proc.stdin, writer, TO_ADAPTER), daemon=True)
+    to_adapter.start()
+    pump(proc.stdout, sys.stdout.buffer, writer, FROM_ADAPTER)
+    status = proc.wait()
+    writer.close()
+    return status
+
+def show(capture, args):
+    t0 = {}
+    for e in capture.select(args.start, args.count, args.command, session=args.session):
+        # times are from the start of the session
+        if e.session not in t0:
+            t0[e.session] = next(capture.select(session=e.session)).time
+        print('{:>6} {:>4} {:>12.6f} {} {:<8} {:>6} {:>6} {}'.format(
+            e.n, e.session, e.time - t0[e.session], '>' if e.direction == TO_ADAPTER else '<',
+            e.kind, e.seq, e.request_seq, e.command))
+        if args.payload:
+            print(capture.payload(e).decode('utf-8', 'replace'))
+
+def diff(recorded, actual, path=''):
+    # (path, recorded, actual) of every value that differs
+    if isinstance(recorded, dict) and isinstance(actual, dict):
+        out = []
+        for k in sorted(set(recorded) | set(actual), key=str):
+            out += diff(recorded.get(k), actual.get(k), '{}/{}'.format(path, k))
+        return out
+    if isinstance(recorded, list) and isinstance(actual, list) and len(recorded) == len(actual):
+        out = []
+        for i, (r, a) in enumerate(zip(recorded, actual)):
+            out += diff(r, a, '{}/{}'.format(path, i))
+        return out
+    return [] if recorded == actual else [(path or '/', recorded, actual)]
+
+async def replay_requests(conn, capture, entries, realtime):
+    # the actual response, or the exception, for each request entry
+    results = {}
+    async def send(e):
+        try:
+            results[e.n] = (await conn.send(capture.message(e)))[0]
+        except (asyncio.TimeoutError, EOFError) as exc:
+            results[e.n] = exc
+    tasks = []
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for e in entries:
+        if realtime:
+            await asyncio.sleep(max(0.0, e.time - entries[0].time - (loop.time() - start)))
+            tasks.append(asyncio.ensure_future(send(e)))
+        else:
+            await send(e)
+    await asyncio.gather(*tasks)
+    return results
+
+def replay_session(capture, args, session):
+    # requests the client sent, and the recorded response to each by seq
+    requests = [e for e in capture.select(args.start, args.count, args.command, TO_ADAPTER, session)
+                if e.kind == 'request']
+    responses = {}
+    for e in capture.select(direction=FROM_ADAPTER, session=session):
+        if e.kind == 'response':
+            responses.setdefault(e.request_seq, e)
+
+    async def run():
+        conn = await load_test.Connection.spawn(args.adapter, args.timeout)
+        try:
+            return await replay_requests(conn, capture, requests, args.realtime)
+        finally:
+            await conn.close()
+    results = asyncio.run(run()) if requests else {}
+
+    same = differ = failed = 0
+    for e in requests:
+        actual = results.get(e.n)
+        if not isinstance(actual, dict):
+            failed += 1
+            print('#{} {} seq {}: no response ({})'.format(e.n, e.command, e.seq, type(actual).__name__))
+            continue
+        recorded = responses.get(e.seq)
+        if recorded is None:
+            continue
+        # the adapter numbers its messages itself
+        changes = [d for d in diff(capture.message(recorded), actual) if d[0] != '/seq']
+        if not changes:
+            same += 1
+            continue
+        differ += 1
+        print('#{} {} seq {}:'.format(e.n, e.command, e.seq))
+        for path, r, a in changes[:args.max_diffs]:
+            print('  {}: {} -> {}'.format(path, json.dumps(r), json.dumps(a)))
+        if len(changes) > args.max_diffs:
+            print('  ... {} more'.format(len(changes) - args.max_diffs))
+    return len(requests), same, differ, failed
+
+def replay(capture, args):
+    if args.session is not None:
+        sessions = [args.session]
+    else:
+        sessions = sorted(set(e.session for e in capture.select(args.start, args.count)))
+    totals = [0, 0, 0, 0]
+    start = time.perf_counter()
+    for session in sessions:
+        counts = replay_session(capture, args, session)
+        print('session {}: {} requests, {} same, {} differ, {} unanswered, {} not recorded'.format(
+            session, counts[0], counts[1], counts[2], counts[3], counts[0] - sum(counts[1:])))
+        totals = [a + b for a, b in zip(totals, counts)]
+    elapsed = time.perf_counter() - start
+    n, same, differ, failed = totals
+    print('replayed {} requests of {} sessions in {:.3f}s: {} same, {} differ, {} unanswered, {} not recorded'.format(
+        n, len(sessions), elapsed, same, differ, failed, n - same - differ - failed))
+    return 1 if differ or failed else 0
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Record debug sessions and replay them against the adapter',
+                                     epilog='The adapter command line comes last, after --, '
+                                            'e.g. capture.py record session.dapcap -- ./sml-debug-adapter')
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    p = sub.add_parser('record', usage='%(prog)s capture -- adapter [args ...]',
+                       help='run the adapter, recording everything between it and the client')
+    p.add_argument('capture')
+
+    def selection(p):
+        p.add_argument('capture')
+        p.add_argument('--start', type=int, default=0, help='first message, by number')
+        p.add_argument('--count', type=int, help='messages from start on to look at')
+        p.add_argument('--command', help='only messages of this command or event')
+        p.add_argument('--session', type=int, help='only messages of this session')
+
+    p = sub.add_parser('show', help='list the messages of a capture')
+    selection(p)
+    p.add_argument('--payload', action='store_true', help='print each message too')
+
+    p = sub.add_parser('replay', usage='%(prog)s [options] capture [-- adapter [args ...]]',
+                       help='send the recorded requests to the adapter (./sml-debug-adapter unless given after --) '
+                            'and compare the responses')
+    selection(p)
+    p.add_argument('--realtime', action='store_true', help='at the recorded pace instead of as fast as the adapter answers')
+    p.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for each response')
+    p.add_argument('--max-diffs', type=int, default=10, help='differences shown per response')
+    options, command = load_test.split_command(argv[1:])
+    args = parser.parse_args(options)
+    if args.mode == 'record' and not command:
+        parser.error('record needs the adapter command line after --')
+    args.adapter = command or ['./sml-debug-adapter']
+
+    if args.mode == 'record':
+        return record(args.capture, args.adapter)
+    capture = Capture(args.capture)
+    try:
+        return show(capture, args) if args.mode == 'show' else replay(capture, args)
+    finally:
+        capture.close()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
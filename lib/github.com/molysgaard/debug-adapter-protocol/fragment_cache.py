@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+
+# Content addressed cache of the SML emitted per definition. A fragment key
+# covers the definition's own schema subtree and, transitively, every
+# definition it reaches through `$ref`, so editing one definition only
+# invalidates the structures that can observe the edit.
+
+def canonical_json(obj):
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'))
+
+def schema_refs(schem, out):
+    if isinstance(schem, dict):
+        for k, v in schem.items():
+            if k == '$ref' and isinstance(v, str):
+                out.add(v[len('#/definitions/'):])
+            else:
+                schema_refs(v, out)
+    elif isinstance(schem, list):
+        for v in schem:
+            schema_refs(v, out)
+    return out
+
+def strongly_connected(graph):
+    # Iterative Tarjan. Components come out dependencies first, which is the
+    # order their keys have to be computed in.
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    comps = []
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph[root]))]
+        while work:
+            node, it = work[-1]
+            for dep in it:
+                if dep not in index:
+                    index[dep] = low[dep] = len(index)
+                    stack.append(dep)
+                    on_stack.add(dep)
+                    work.append((dep, iter(graph[dep])))
+                    break
+                elif dep in on_stack:
+                    low[node] = min(low[node], index[dep])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    comp = []
+                    while True:
+                        n = stack.pop()
+                        on_stack.discard(n)
+                        comp.append(n)
+                        if n == node:
+                            break
+                    comps.append(comp)
+    return comps
+
+def fragment_keys(definitions, salt=''):
+    graph = {}
+    digests = {}
+    for name, schem in definitions.items():
+        graph[name] = sorted(r for r in schema_refs(schem, set()) if r in definitions)
+        digests[name] = hashlib.sha256(canonical_json(schem).encode('utf-8')).hexdigest()
+
+    comp_keys = {}
+    keys = {}
+    for comp in strongly_connected(graph):
+        members = set(comp)
+        h = hashlib.sha256(salt.encode('utf-8'))
+        for n in sorted(comp):
+            h.update('{}={};'.format(n, digests[n]).encode('utf-8'))
+        ext = sorted(set(d for n in comp for d in graph[n] if d not in members))
+        for d in ext:
+            h.update('{}->{};'.format(d, comp_keys[d]).encode('utf-8'))
+        comp_key = h.hexdigest()
+        for n in comp:
+            comp_keys[n] = comp_key
+            keys[n] = hashlib.sha256('{}:{}'.format(comp_key, n).encode('utf-8')).hexdigest()
+    return keys
+
+def extend_key(key, names):
+    # A fragment that also depends on things outside its schema, e.g. the
+    # names of structures generated for shapes it shares with others.
+    if not names:
+        return key
+    return hashlib.sha256('{}+{}'.format(key, ','.join(sorted(names))).encode('utf-8')).hexdigest()
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class FragmentCache(object):
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, 'fragments.json')
+        self.fragments = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.fragments = json.load(f)
+            except ValueError:
+                self.fragments = {}
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        text = self.fragments.get(key)
+        if text is None:
+            text = render()
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.used[key] = text
+        return text
+
+    def save(self):
+        # Only the fragments used by this run are kept, so the cache does not
+        # grow with every schema revision.
+        if self.used == self.fragments:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_if_changed(self.path, json.dumps(self.used, sort_keys=True).encode('utf-8'))
+        self.fragments = self.used
+
+def write_if_changed(path, data):
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return True
+
+def write_depfile(path, target, deps):
+    def escape(p):
+        return p.replace(' ', '\\ ')
+    line = '{}: {}\n'.format(escape(target), ' '.join(escape(d) for d in deps))
+    return write_if_changed(path, line.encode('utf-8'))
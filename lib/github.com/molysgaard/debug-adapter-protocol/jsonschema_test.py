@@ -1,14 +1,28 @@
+import argparse
+import concurrent.futures
+import contextlib
+import copy
+import hashlib
+import io
 import json
+import os
+import pickle
+import sys
+import tempfile
+import time
 import toposort
+import tracemalloc
+import zlib
+
+import fragment_cache
 
 # These should not be code-generated
 ignored_schems = ['ProtocolMessage', 'Request', 'Event', 'Response']
 prop_name_to_field = {'type':'type_', '__restart':'restart__'}
 field_name_to_prop = dict([(v,k) for k,v in prop_name_to_field.items()])
-
-dap_json = json.load(open('debugProtocol.json'))
-
-indent = 0
+# base64 string fields, decoded to bytes. The schema only says so in their
+# descriptions, they get contentEncoding before conversion (see mark_bytes).
+bytes_fields = [('ReadMemoryResponse', 'body', 'data')]
 
 class UnknownRefException(Exception):
     def __init__(self, converted, n):
@@ -16,29 +30,105 @@ class UnknownRefException(Exception):
         self.n = n
 
     def __str__(self):
-        return 'Couldnt find {} in {}'.format(self.n, self.converted)
+        return 'Couldnt find {} in definitions'.format(self.n)
+
+class ReservedNameException(Exception):
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return 'Definition {} would shadow the runtime structure of that name'.format(self.name)
+
+class CyclicRefException(Exception):
+    def __init__(self, chain):
+        self.chain = chain
 
-def deref(converted, schem):
-    ref = schem['$ref']
+    def __str__(self):
+        return 'Cyclic $ref: {}'.format(' -> '.join(self.chain))
+
+def ref_name(ref):
     prefix = '#/definitions/'
     assert ref.startswith(prefix)
+    return ref[len(prefix):]
+
+class Resolver(object):
+    # Converts definitions on demand, each one exactly once. A definition only
+    # has to be converted before another one when it is merged through `allOf`,
+    # plain `$ref` properties stay RefObj and are ordered later through deps().
+    #
+    # Inline types are hash-consed: every distinct shape has one canonical
+    # node, so equal shapes are the same object and unions of them only have
+    # to be computed once.
+    def __init__(self, definitions):
+        self.definitions = definitions
+        self.converted = {}
+        self.active = []
+        self.active_set = set()
+        self.nodes = {}
+        self.interned = set()
+        self.unions = {}
+        # ids of the definitions' own nodes, which must not become canonical
+        self.named = set()
+
+    def intern(self, t):
+        # t's parts have to be canonical already
+        c = self.nodes.setdefault(t.key(), t)
+        self.interned.add(id(c))
+        return c
+
+    def canonical(self, t):
+        # like intern, but for types built outside make(), e.g. by union
+        if id(t) in self.interned:
+            return t
+        if isinstance(t, Record):
+            props = dict((k, self.canonical(v)) for k, v in t.props.items())
+            if any(props[k] is not t.props[k] for k in props):
+                t = Record(t.name, t.descr, props)
+        elif isinstance(t, Option):
+            o = self.canonical(t.o)
+            if o is not t.o:
+                t = Option(o)
+        elif isinstance(t, (Array, StringMap)):
+            e = self.canonical(t.e)
+            if e is not t.e:
+                t = type(t)(e)
+        if id(t) in self.named:
+            t = copy.copy(t)
+        return self.intern(t)
+
+    def union(self, a, b):
+        k = (id(a), id(b))
+        if k not in self.unions:
+            # a and b are kept alive along with the result, so their ids stay theirs
+            self.unions[k] = (a, b, self.canonical(a.union(b)))
+        return self.unions[k][2]
+
+    def resolve(self, name):
+        if name in self.converted:
+            return self.converted[name]
+        if name in self.active_set:
+            raise CyclicRefException(self.active[self.active.index(name):] + [name])
+        if name not in self.definitions:
+            raise UnknownRefException(self.converted, name)
+
+        self.active.append(name)
+        self.active_set.add(name)
+        try:
+            obj = make(self, name, self.definitions[name], inline=False)
+        finally:
+            self.active.pop()
+            self.active_set.discard(name)
+
+        self.converted[name] = obj
+        self.named.add(id(obj))
+        return obj
 
-    name = ref[len(prefix):]
-    if name in converted:
-        return converted[name]
-    else:
-        raise UnknownRefException(converted, name)
+def deref(resolver, schem):
+    return resolver.resolve(ref_name(schem['$ref']))
 
-def deref_if_ref(converted, obj):
+def deref_if_ref(resolver, obj):
     if isinstance(obj, RefObj):
-        prefix = '#/definitions/'
-        assert obj.ref.startswith(prefix)
-
-        name = obj.ref[len(prefix):]
-        if name in converted:
-            return converted[name]
-        else:
-            raise UnknownRefException(converted, name)
+        return resolver.resolve(ref_name(obj.ref))
     else:
         return obj
 
@@ -51,24 +141,33 @@ class UnionException(Exception):
         return 'Could not union:\n  {}\n  {}'.format(self.cur, self.new)
 
 
-def process_union(converted, objs, schem):
+def process_union(resolver, objs, schem):
     dereffed_ojbs = []
     for o in objs:
-        dereffed_ojbs.append(deref_if_ref(converted, o))
+        dereffed_ojbs.append(deref_if_ref(resolver, o))
 
     out_obj = dereffed_ojbs[0]
     for o in dereffed_ojbs:
-        out_obj = out_obj.union(o)
+        out_obj = resolver.union(out_obj, o)
 
     return out_obj
 
-def make(converted, name, schem):
+def make(resolver, name, schem, inline=True):
+    # Definitions (inline=False) get nodes of their own, named after them,
+    # anything inside them the canonical node of its shape.
     if 'allOf' in schem:
-        obj = process_union(converted, [make(converted, name, o) for o in schem['allOf']], schem)
+        obj = process_union(resolver, [make(resolver, name, o) for o in schem['allOf']], schem)
+        if inline:
+            return obj
+        obj = copy.copy(obj)
         obj.name = name
         obj.descr = schem.get('description', obj.descr)
         return obj
-    elif 'type' not in schem and '$ref' in schem:
+    obj = make_type(resolver, name, schem)
+    return resolver.intern(obj) if inline else obj
+
+def make_type(resolver, name, schem):
+    if 'type' not in schem and '$ref' in schem:
         return RefObj(name, schem)
 
     t = schem['type']
@@ -85,19 +184,21 @@ def make(converted, name, schem):
             return Integer(schem)
         elif t == 'number':
             return Real(schem)
+        elif t=='string' and schem.get('contentEncoding') == 'base64':
+            return Bytes(schem)
         elif t=='string':
             return String(schem)
         elif t=='boolean':
             return Boolean(schem)
         elif t=='array':
-            tmp = make(converted, name, schem['items'])
+            tmp = make(resolver, name, schem['items'])
             return Array(tmp)
         elif t=='object' and 'properties' in schem:
-            return Record(converted, name, schem)
+            return Record(resolver, name, schem)
         elif t == 'object' and 'additionalProperties' in schem and set(schem['additionalProperties']['type']) == {'string', 'null'}:
-            return StringMap(NullableString(schem))
+            return StringMap(resolver.intern(NullableString(schem)))
         elif t == 'object' and 'additionalProperties' in schem and {schem['additionalProperties']['type']} == {'string'}:
-            return StringMap(String(schem))
+            return StringMap(resolver.intern(String(schem)))
         elif t=='object' and set(schem.keys()) == {'description','type'}:
             return JsonObject(schem)
         else:
@@ -111,6 +212,20 @@ class TypeBase(object):
     def deps(self):
         return set()
 
+    def structure_deps(self):
+        # the deps of the structure emitted for this type
+        return self.deps()
+
+    def key(self):
+        # the shape, everything the generated code depends on, which is
+        # what hash-consing compares. Parts are canonical by the time a key
+        # is taken, so they are compared by identity.
+        return (type(self).__name__,)
+
+    def json_constant(self):
+        # JSON text of values that are the same for every instance
+        return None
+
     def union(self, other):
         if self == other:
             return self
@@ -119,52 +234,117 @@ class TypeBase(object):
 
 
 class Enum(TypeBase):
+    # Enums with a single value are constants, they stay strings and are
+    # written from a literal. Any other enum is a datatype: definitions get a
+    # structure of their own, inline enums a structure inside the one they
+    # are emitted in, or a shared one when they occur more than once (see
+    # share_inline). `_enum` only suggests values, those get an Other
+    # constructor for the rest.
     def __init__(self, *args):
         super().__init__(False)
         if len(args)==2:
             self.init_from_json(*args)
-        elif len(args)==3:
+        elif len(args) in (3, 4):
             self.init_from_values(*args)
         else:
             assert False, 'Enum with wrong number of arguments'
+        # set by share_inline for inline enums
+        self.owner = None
+        self.shared = None
+        self.binding = constant_binding(self.constant()) if self.constant() is not None else self.name
 
-    def init_from_values(self, name, descr, values):
+    def init_from_values(self, name, descr, values, open_=False):
         self.name = name
         self.descr = descr
-        self.values = values
+        self.values = list(values)
+        self.open = open_
 
     def init_from_json(self, name, schem):
         self.name = name
         self.descr = schem.get('description', '')
-        self.values = schem.get('enum', schem.get('_enum'))
+        self.values = list(schem.get('enum', schem.get('_enum')))
+        self.open = 'enum' not in schem
+
+    def constant(self):
+        if len(self.values)==1 and not self.open:
+            return self.values[0]
+        return None
+
+    def key(self):
+        return ('Enum', tuple(self.values), self.open)
+
+    def deps(self):
+        return {self.shared} if self.shared is not None else set()
+
+    def structure_deps(self):
+        return set()
+
+    def qualified(self, n):
+        # the structure (or constant) this enum is emitted as, seen from n
+        if self.owner is None or n == self.owner:
+            return self.binding
+        return '{}.{}'.format(self.owner, self.binding)
 
     def s(self, n):
-        return 'string'
+        if self.constant() is not None:
+            return 'string'
+        return '{}.t'.format(self.qualified(n))
 
     def to_json(self, n, f):
-        if len(self.values)==1:
-            return '(String.toJson "{}")'.format(next(iter(self.values)))
+        if self.constant() is not None:
+            # every structure has the values of the constants it uses
+            return self.binding if f else '(fn _ => {})'.format(self.binding)
+        if f:
+            return '({}.toJson {})'.format(self.qualified(n), f)
         else:
+            return '{}.toJson'.format(self.qualified(n))
+
+    def write_json(self, n, f):
+        if self.constant() is not None:
             if f:
-                return '(String.toJson {})'.format(f)
+                return '(JsonBuf.add (b, {}))'.format(sml_string(self.json_constant()))
             else:
-                return 'String.toJson'
-    
+                return '(fn _ => JsonBuf.add (b, {}))'.format(sml_string(self.json_constant()))
+        if f:
+            return '({}.writeJson b {})'.format(self.qualified(n), f)
+        else:
+            return '({}.writeJson b)'.format(self.qualified(n))
+
+    def json_constant(self):
+        if self.constant() is not None:
+            return json.dumps(self.constant())
+        return None
+
+    def read_json(self, n):
+        if self.constant() is not None:
+            return '(Constant.readJson {})'.format(sml_string(self.constant()))
+        return '{}.readJson'.format(self.qualified(n))
+
     def from_json(self, n, f):
+        if self.constant() is not None:
+            if f:
+                return '(Constant.fromJson {} {})'.format(sml_string(self.constant()), f)
+            else:
+                return '(Constant.fromJson {})'.format(sml_string(self.constant()))
         if f:
-            return '(JSONUtil.asString {})'.format(f)
+            return '({}.fromJson {})'.format(self.qualified(n), f)
         else:
-            return 'JSONUtil.asString'
+            return '{}.fromJson'.format(self.qualified(n))
 
     def __str__(self):
         return self.s()
 
     def __eq__(self, other):
-        return isinstance(other,Enum) and self.values==other.values
+        return isinstance(other,Enum) and self.values==other.values and self.open==other.open
 
     def union(self, other):
         if isinstance(other, Enum):
-            valid_values = set(self.values).intersection(other.values)
+            # suggested values do not restrict the other side
+            if self.open and other.open:
+                return Enum(self.name, self.descr, self.values + [v for v in other.values if v not in self.values], True)
+            elif self.open:
+                return other.union(self)
+            valid_values = [v for v in self.values if other.open or v in other.values]
             if len(valid_values)!=0:
                 return Enum(self.name, self.descr, valid_values)
             else:
@@ -198,6 +378,22 @@ class RefObj(TypeBase):
             else:
                 return '{}.toJson'.format(self.parse_name())
     
+    def write_json(self, n, f):
+        if n==self.parse_name():
+            w = '(writeJson b)'
+        else:
+            w = '({}.writeJson b)'.format(self.parse_name())
+        if f:
+            return '({} {})'.format(w[1:-1], f)
+        else:
+            return w
+
+    def read_json(self, n):
+        if n==self.parse_name():
+            return 'readJson'
+        else:
+            return '{}.readJson'.format(self.parse_name())
+
     def from_json(self, n, f):
         if n==self.parse_name():
             if f:
@@ -211,69 +407,65 @@ class RefObj(TypeBase):
                 return '{}.fromJson'.format(self.parse_name())
 
     def parse_name(self):
-        prefix = '#/definitions/'
-        assert self.ref.startswith(prefix)
-        return self.ref[len(prefix):]
+        return ref_name(self.ref)
+
+    def key(self):
+        return ('RefObj', self.ref)
 
     def __str__(self):
         return self.s()
 
     def __eq__(self, other):
-        return isinstance(other,Enum) and self.values==other.values
+        return isinstance(other,RefObj) and self.ref==other.ref
 
     def deps(self):
         return {self.parse_name()}
 
-    def union(self, other):
-        assert False, 'Union called for RefObj which should never happen'
-
 class Record(TypeBase):
+    # An inline record whose shape occurs more than once is emitted as a
+    # structure of its own, named by shared (see share_inline).
     def __init__(self, *args):
         super().__init__(False)
         if isinstance(args[0], str):
             self.init_from_internal(*args)
         else:
             self.init_from_json(*args)
+        self.shared = None
 
     def init_from_internal(self, name, descr, props):
         self.name=name
         self.descr=descr
         self.props=props
-        deps = set()
-        for p in self.props.values():
-            deps = deps.union(p.deps())
-        self.ddeps = deps
 
-    def init_from_json(self, converted, name, obj):
+    def init_from_json(self, resolver, name, obj):
         self.name = name
         self.descr = obj.get('description','')
         self.props = {}
-        self.ddeps = set()
-
-        # first we rename any properties that should be renamed because of name classeh with SML syntax
-        if 'properties' in obj:
-            ks = list(obj['properties'].keys())
-            for k in ks:
-                if k in prop_name_to_field:
-                    obj['properties'][prop_name_to_field[k]] = obj['properties'][k]
-                    del obj['properties'][k]
 
-        # compute which properties are required and not
-        props = set(obj['properties'].keys()) if 'properties' in obj else set()
-        req_props = set(obj['required']) if 'required' in obj else props
-        opt_props = props.difference(req_props)
-
-        deps = set()
-        if props:
-            for prop_name, prop_descr in obj['properties'].items():
-                #basic_descr = get_prop_type(opt_props, prop_name, prop_descr)
-                basic_descr = make(converted, prop_name, prop_descr)
-                self.props[prop_name] = basic_descr
-                deps = deps.union(basic_descr.deps())
-
-        self.ddeps = deps
+        # properties whose names clash with SML syntax are renamed, the schema
+        # itself is left as it is
+        req_props = set(prop_name_to_field.get(k, k) for k in obj.get('required', []))
+        for prop, prop_descr in obj.get('properties', {}).items():
+            prop_name = prop_name_to_field.get(prop, prop)
+            basic_descr = make(resolver, prop_name, prop_descr)
+            if prop_name not in req_props:
+                basic_descr = resolver.intern(Option(basic_descr))
+            self.props[prop_name] = basic_descr
+
+    def key(self):
+        if '_key' not in self.__dict__:
+            self._key = ('Record', tuple((k, id(v)) for k, v in self.props.items()))
+        return self._key
+
+    def __getstate__(self):
+        # the cached key is made of ids, which mean nothing once unpickled
+        state = dict(self.__dict__)
+        state.pop('_key', None)
+        return state
 
     def s(self, n):
+        if self.shared is not None and n != self.shared:
+            return '{}.t'.format(self.shared)
         tmp = []
         for k,v in self.props.items():
             assert hasattr(v,'s')
@@ -282,25 +474,50 @@ class Record(TypeBase):
         return '{{\n{}\n}}'.format(fields)
 
     def to_json(self, n, f):
+        if self.shared is not None and n != self.shared:
+            return '({}.toJson {})'.format(self.shared, f) if f else '{}.toJson'.format(self.shared)
         if f:
-            fields = []
-            for k,v in self.props.items():
-                fields.append('("{}", {})'.format(k, v.to_json(n, '(#{} {})'.format(k, f))))
+            fields, optional = record_fields(n, self.props, f)
+            if optional:
+                return '(Json.OBJECT (List.concat [{}]))'.format(', '.join(fields))
             return '(Json.OBJECT [{}])'.format(', '.join(fields))
         else:
-            return 'id'
+            return '(fn x => {})'.format(self.to_json(n, 'x'))
+
+    def write_json(self, n, f):
+        if self.shared is not None and n != self.shared:
+            return '({}.writeJson b {})'.format(self.shared, f) if f else '({}.writeJson b)'.format(self.shared)
+        stmts = '; '.join(record_writer(n, self.props, 'x'))
+        if f:
+            return '(let val x = {} in {} end)'.format(f, stmts)
+        else:
+            return '(fn x => ({}))'.format(stmts)
+
+    def read_json(self, n):
+        if self.shared is not None and n != self.shared:
+            return '{}.readJson'.format(self.shared)
+        decls, fields = record_reader(n, self.props)
+        return '(fn p => let {} in {{ {} }} end)'.format(' '.join(decls).replace('\n  ', ' '), ', '.join(fields))
 
     def from_json(self, n, f):
+        if self.shared is not None and n != self.shared:
+            return '({}.fromJson {})'.format(self.shared, f) if f else '{}.fromJson'.format(self.shared)
         if f:
-            fields = []
-            for k,v in self.props.items():
-                fields.append('{}={}'.format(k, v.from_json(n, '(JSONUtil.lookupField {} "{}")'.format(f, k))))
-            return '{{ {} }}'.format(', '.join(fields))
+            decls, fields = record_decoder(n, self.props)
+            return '(let val x = {} {} in {{ {} }} end)'.format(f, ' '.join(decls).replace('\n  ', ' '), ', '.join(fields))
         else:
-            return 'id'
+            return '(fn x => {})'.format(self.from_json(n, 'x'))
 
     def deps(self):
-        return self.ddeps
+        if self.shared is not None:
+            return {self.shared}
+        return self.structure_deps()
+
+    def structure_deps(self):
+        deps = set()
+        for p in self.props.values():
+            deps.update(p.deps())
+        return deps
 
     def __str__(self):
         return self.s()
@@ -311,14 +528,15 @@ class Record(TypeBase):
     def union(self, other):
         if isinstance(other, Record):
             n_props = {}
-            all_keys = set(self.props.keys()).union(set(other.props.keys()))
+            # keep declaration order, a set here would make the output depend on the hash seed
+            all_keys = list(self.props) + [k for k in other.props if k not in self.props]
             for k in all_keys:
                 if k in self.props and not k in other.props:
                     n_props[k] = self.props[k]
                 elif not k in self.props and k in other.props:
                     n_props[k] = other.props[k]
                 else:
-                    n_props[k] = self.props[k].union(other.props[k])
+                    n_props[k] = union_props(self.props[k], other.props[k])
 
             return Record(self.name, self.descr, n_props)
         elif isinstance(other, JsonObject):
@@ -327,6 +545,14 @@ class Record(TypeBase):
             raise UnionException(self, other)
 
 
+def union_props(a, b):
+    # A property is only optional when no part of an allOf requires it.
+    if isinstance(a, Option) and isinstance(b, Option):
+        return Option(a.o.union(b.o))
+    a = a.o if isinstance(a, Option) else a
+    b = b.o if isinstance(b, Option) else b
+    return a.union(b)
+
 class Integer(TypeBase):
     def __init__(self, schem):
         super().__init__(schem)
@@ -340,6 +566,15 @@ class Integer(TypeBase):
         else:
             return 'Int.toJson'
     
+    def write_json(self, n, f):
+        if f:
+            return '(Int.writeJson b {})'.format(f)
+        else:
+            return '(Int.writeJson b)'
+
+    def read_json(self, n):
+        return 'Int.readJson'
+
     def from_json(self, n, f):
         if f:
             return '(JSONUtil.asInt {})'.format(f)
@@ -366,6 +601,15 @@ class Real(TypeBase):
         else:
             return 'Real.toJson'
     
+    def write_json(self, n, f):
+        if f:
+            return '(Real.writeJson b {})'.format(f)
+        else:
+            return '(Real.writeJson b)'
+
+    def read_json(self, n):
+        return 'Real.readJson'
+
     def from_json(self, n, f):
         if f:
             return '(JSONUtil.asNumber {})'.format(f)
@@ -392,6 +636,15 @@ class Boolean(TypeBase):
         else:
             return 'Bool.toJson'
     
+    def write_json(self, n, f):
+        if f:
+            return '(Bool.writeJson b {})'.format(f)
+        else:
+            return '(Bool.writeJson b)'
+
+    def read_json(self, n):
+        return 'Bool.readJson'
+
     def from_json(self, n, f):
         if f:
             return '(JSONUtil.asBool {})'.format(f)
@@ -418,6 +671,15 @@ class String(TypeBase):
         else:
             return 'String.toJson'
     
+    def write_json(self, n, f):
+        if f:
+            return '(String.writeJson b {})'.format(f)
+        else:
+            return '(String.writeJson b)'
+
+    def read_json(self, n):
+        return 'String.readJson'
+
     def from_json(self, n, f):
         if f:
             return '(JSONUtil.asString {})'.format(f)
@@ -437,6 +699,42 @@ class String(TypeBase):
             return super().union(other)
 
 
+class Bytes(TypeBase):
+    # base64 strings, decoded to the bytes they encode. The bytes are a list of
+    # chunks, so a memory read in chunks is encoded without joining them first.
+    def __init__(self, schem):
+        super().__init__(schem)
+
+    def s(self, n):
+        return 'Word8Vector.vector list'
+
+    def to_json(self, n, f):
+        if f:
+            return '(Base64.toJson {})'.format(f)
+        else:
+            return 'Base64.toJson'
+
+    def write_json(self, n, f):
+        if f:
+            return '(Base64.writeJson b {})'.format(f)
+        else:
+            return '(Base64.writeJson b)'
+
+    def read_json(self, n):
+        return 'Base64.readJson'
+
+    def from_json(self, n, f):
+        if f:
+            return '(Base64.fromJson {})'.format(f)
+        else:
+            return 'Base64.fromJson'
+
+    def __str__(self):
+        return self.s()
+
+    def __eq__(self, other):
+        return isinstance(other, Bytes)
+
 class IntOrString(TypeBase):
     def __init__(self, schem):
         super().__init__(schem)
@@ -450,6 +748,15 @@ class IntOrString(TypeBase):
         else:
             return 'IntOrString.toJson'
 
+    def write_json(self, n, f):
+        if f:
+            return '(IntOrString.writeJson b {})'.format(f)
+        else:
+            return '(IntOrString.writeJson b)'
+
+    def read_json(self, n):
+        return 'IntOrString.readJson'
+
     def from_json(self, n, f):
         if f:
             return '(IntOrString.fromJson {})'.format(f)
@@ -476,6 +783,15 @@ class NullableString(TypeBase):
         else:
             return 'NullableString.toJson'
 
+    def write_json(self, n, f):
+        if f:
+            return '(NullableString.writeJson b {})'.format(f)
+        else:
+            return '(NullableString.writeJson b)'
+
+    def read_json(self, n):
+        return 'NullableString.readJson'
+
     def from_json(self, n, f):
         if f:
             return '(NullableString.fromJson {})'.format(f)
@@ -503,6 +819,15 @@ class StringMap(TypeBase):
         else:
             return '(StringMap.toJson {})'.format(self.e.to_json(n,False))
 
+    def write_json(self, n, f):
+        if f:
+            return '(StringMap.writeJson b {} {})'.format(self.e.write_json(n,False), f)
+        else:
+            return '(StringMap.writeJson b {})'.format(self.e.write_json(n,False))
+
+    def read_json(self, n):
+        return '(StringMap.readJson {})'.format(self.e.read_json(n))
+
     def from_json(self, n, f):
         if f:
             return '(StringMap.fromJson {} {})'.format(self.e.from_json(n,False), f)
@@ -515,6 +840,9 @@ class StringMap(TypeBase):
     def __eq__(self, other):
         return isinstance(other, StringMap)
 
+    def key(self):
+        return ('StringMap', id(self.e))
+
     def deps(self):
         return self.e.deps()
 
@@ -532,6 +860,15 @@ class JsonObject(TypeBase):
         else:
             return 'id'
 
+    def write_json(self, n, f):
+        if f:
+            return '(JsonBuf.addValue b {})'.format(f)
+        else:
+            return '(JsonBuf.addValue b)'
+
+    def read_json(self, n):
+        return 'JsonPull.readValue'
+
     def from_json(self, n, f):
         if f:
             return f
@@ -562,6 +899,15 @@ class Array(TypeBase):
         else:
             assert False, 'List.to_json without field'
 
+    def write_json(self, n, f):
+        if f:
+            return '(JsonBuf.addList b {} {})'.format(self.e.write_json(n, False), f)
+        else:
+            return '(JsonBuf.addList b {})'.format(self.e.write_json(n, False))
+
+    def read_json(self, n):
+        return '(JsonPull.list {})'.format(self.e.read_json(n))
+
     def from_json(self, n, f):
         if f:
             return '(List.map {} (vectorToList (JSONUtil.asArray {})))'.format(self.e.from_json(n, False), f)
@@ -577,6 +923,9 @@ class Array(TypeBase):
     def __eq__(self, other):
         return isinstance(other, Array) and self.e == other.e
 
+    def key(self):
+        return ('Array', id(self.e))
+
 
 class Option(TypeBase):
     def __init__(self, o):
@@ -592,172 +941,1140 @@ class Option(TypeBase):
         else:
             assert False
 
+    def write_json(self, n, f):
+        if f:
+            return '(Option.writeJson b {} {})'.format(self.o.write_json(n, False), f)
+        else:
+            return '(Option.writeJson b {})'.format(self.o.write_json(n, False))
+
+    def read_json(self, n):
+        return '(Option.readJson {})'.format(self.o.read_json(n))
+
     def from_json(self, n, f):
         if f:
-            return '(Option.fromJson ({},{}))'.format(self.o.to_json(n, False), f)
+            return '(Option.fromJson (fn v => {}, {}))'.format(self.o.from_json(n, 'v'), f)
         else:
             assert False
 
     def deps(self):
         return self.o.deps()
 
+    def union(self, other):
+        return union_props(self, other)
+
     def __str__(self):
         return self.s()
 
     def __eq__(self, other):
         return isinstance(other,Option) and self.o==other.o
 
+    def key(self):
+        return ('Option', id(self.o))
 
-def i_print(s):
-    global indent
-
-    idnt = ''
-    for _i in range(indent):
-        idnt = ' ' + idnt
 
-    s = s.replace('\n', '\n'+idnt)
-    s = idnt + s
-
-    print(s)
-
-def print_obj(obj):
-    global indent
-    i_print('structure {} = struct'.format(obj.name))
-    indent += 2
-    i_print('(* {} *)'.format(obj.descr))
-
-    i_print('datatype t = T of {')
+def record_decoder(n, props):
+    # Decodes a record in one pass over the object's fields: each field is
+    # stored in its own slot as it is seen and the record is built once at
+    # the end, instead of a lookupField scan per property.
+    decls = ['val f_{} = slot ()'.format(k) for k in props]
+    cases = ['("{}", v) = f_{} := SOME v'.format(field_name_to_prop.get(k,k), k) for k in props]
+    decls.append('fun field ' + '\n  | field '.join(cases + ['_ = ()']))
+    decls.append('val () = List.app field (objectFields x)')
     fields = []
-    for prop_name,prop_type in obj.props.items():
-        fields.append('{}: {}'.format(prop_name, prop_type.s(obj.name)))
-    indent += 2
-    i_print(',\n'.join(fields))
-    indent -= 2
-    i_print('}')
-
-    print()
-    print()
+    for k,v in props.items():
+        if isinstance(v, Option):
+            # absent and null both decode to NONE
+            fields.append('{}=Option.fromField (fn v => {}) f_{}'.format(k, v.o.from_json(n, 'v'), k))
+        else:
+            fields.append('{}={}'.format(k, v.from_json(n, '(required x "{}" f_{})'.format(field_name_to_prop.get(k,k), k))))
+    return decls, fields
 
-    i_print('fun toJson ((T x) : t) = Json.OBJECT [')
+def record_fields(n, props, x):
+    # The fields of a Json.OBJECT and whether they have to be concatenated,
+    # optional fields are a list that is empty when the field is NONE.
+    optional = any(isinstance(v, Option) for v in props.values())
     fields = []
-    for prop_name,prop_type in obj.props.items():
-        fields.append('("{}", {})'.format(field_name_to_prop.get(prop_name,prop_name), prop_type.to_json(obj.name, '(#{} x)'.format(prop_name))))
-    indent += 2
-    i_print(',\n'.join(fields))
-    indent -= 2
-    i_print(']')
-
-    i_print('fun fromJson (x : Json.value) : t = T {')
+    for k,v in props.items():
+        name = field_name_to_prop.get(k,k)
+        if isinstance(v, Option):
+            fields.append('Option.field ("{}", fn v => {}) (#{} {})'.format(name, v.o.to_json(n, 'v'), k, x))
+        elif optional:
+            fields.append('[("{}", {})]'.format(name, v.to_json(n, '(#{} {})'.format(k, x))))
+        else:
+            fields.append('("{}", {})'.format(name, v.to_json(n, '(#{} {})'.format(k, x))))
+    return fields, optional
+
+def sml_string(s):
+    out = []
+    for c in s.encode('utf-8'):
+        if c in b'"\\':
+            out.append('\\' + chr(c))
+        elif c < 32 or c > 126:
+            out.append('\\{:03d}'.format(c))
+        else:
+            out.append(chr(c))
+    return '"{}"'.format(''.join(out))
+
+def record_writer(n, props, x):
+    # Statements writing a record straight into the JsonBuf `b`. Field names,
+    # separators and constant fields are merged into as few literals as possible.
+    segs = []
+    def lit(text):
+        if segs and isinstance(segs[-1], tuple):
+            segs[-1] = (segs[-1][0] + text,)
+        else:
+            segs.append((text,))
+    sep = '{'
+    # once an optional field may have been left out, separators are only known
+    # at run time and the keys go through JsonBuf.addKey
+    fixed = True
+    for k,v in props.items():
+        key = json.dumps(field_name_to_prop.get(k,k)) + ':'
+        if isinstance(v, Option):
+            if sep == '{':
+                lit('{')
+                sep = ','
+            fixed = False
+            segs.append('(case #{} {} of NONE => () | SOME v => (JsonBuf.addKey (b, {}); {}))'.format(
+                k, x, sml_string(key), v.o.write_json(n, 'v')))
+            continue
+        if fixed:
+            lit(sep + key)
+        else:
+            segs.append('JsonBuf.addKey (b, {})'.format(sml_string(key)))
+        sep = ','
+        c = v.json_constant()
+        if c is not None:
+            lit(c)
+        else:
+            segs.append(v.write_json(n, '(#{} {})'.format(k, x)))
+    lit('}' if props else '{}')
+
+    stmts = []
+    for seg in segs:
+        if not isinstance(seg, tuple):
+            stmts.append(seg)
+        elif len(seg[0])==1:
+            stmts.append('JsonBuf.addChar (b, #{})'.format(sml_string(seg[0])))
+        else:
+            stmts.append('JsonBuf.add (b, {})'.format(sml_string(seg[0])))
+    return stmts
+
+def record_reader(n, props):
+    # Like record_decoder but pulls the fields straight out of the JsonPull
+    # input `p`, unknown fields are skipped without being decoded.
+    decls = ['val f_{} = ref NONE'.format(k) for k in props]
+    branches = []
+    for k,v in props.items():
+        if isinstance(v, Option):
+            # Option.readJson already gives NONE for null
+            branches.append('if JsonPull.keyIs (k, "{}") then f_{} := {} p'.format(field_name_to_prop.get(k,k), k, v.read_json(n)))
+        else:
+            branches.append('if JsonPull.keyIs (k, "{}") then f_{} := SOME ({} p)'.format(field_name_to_prop.get(k,k), k, v.read_json(n)))
+    decls.append('fun field k =\n  ' + '\n  else '.join(branches + ['JsonPull.skip p']))
+    decls.append('val () = JsonPull.object p field')
     fields = []
-    for prop_name,prop_type in obj.props.items():
-        fn = field_name_to_prop.get(prop_name,prop_name)
-        fields.append('{}={}'.format(prop_name, prop_type.from_json(obj.name, '(JSONUtil.lookupField x "{}")'.format(fn))))
-    indent += 2
-    i_print(',\n'.join(fields))
-    indent -= 2
-    i_print('}')
-
-    indent -= 2
-    i_print('end\n')
-
-
-def print_enum(obj):
-    global indent
-    i_print('structure {} = struct'.format(obj.name))
-    indent += 2
-    i_print('(* {} *)'.format(obj.descr))
-
-    tmp = 'datatype t = ' + ' | '.join(obj.values)
-
-    i_print(tmp)
-
-    print()
-    print()
-
-    i_print('fun toJson x = case x of')
-    indent += 2
-    first = True
-    for e in obj.values:
-        if first:
-            first = False
-            i_print('  {} => String.toJson "{}"'.format(e, e))
+    for k,v in props.items():
+        if isinstance(v, Option):
+            fields.append('{}=(!f_{})'.format(k, k))
         else:
-            i_print('| {} => String.toJson "{}"'.format(e, e))
-    indent -= 2
-
-    i_print('fun fromJson x = case JSONUtil.asString x of')
-    indent += 2
-    first = True
-    for e in obj.values:
-        if first:
-            first = False
-            i_print('  "{}" => {}'.format(e, e))
+            fields.append('{}=JsonPull.required p "{}" f_{}'.format(k, field_name_to_prop.get(k,k), k))
+    return decls, fields
+
+class Emitter(object):
+    # Holds the indentation state and buffers the generated text, so the whole
+    # output reaches the stream in a few large writes instead of one per line.
+    def __init__(self, out_stream, buffer_size=1<<16, encoding='utf-8'):
+        self.out_stream = out_stream
+        self.binary = not isinstance(out_stream, io.TextIOBase)
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.indent = 0
+        self.parts = []
+        self.size = 0
+
+    def write(self, s):
+        self.parts.append(s)
+        self.size += len(s)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def i_print(self, s=''):
+        if self.indent:
+            idnt = ' ' * self.indent
+            s = idnt + s.replace('\n', '\n'+idnt)
+        self.write(s + '\n')
+
+    def flush(self):
+        if self.parts:
+            data = ''.join(self.parts)
+            self.out_stream.write(data.encode(self.encoding) if self.binary else data)
+            self.parts = []
+            self.size = 0
+
+def print_obj(em, obj):
+    # A shared record shape is a plain record type, definitions wrap theirs in T.
+    shape = obj.shared is not None
+    name = obj.shared if shape else obj.name
+    con = '' if shape else 'T '
+    arg = '(x : t)' if shape else '((T x) : t)'
+    em.i_print('structure {} = struct'.format(name))
+    em.indent += 2
+    nodes = [node for node, _path in inline_nodes(obj)]
+    printed = set()
+    for e in nodes:
+        if isinstance(e, Enum) and e.owner == name and id(e) not in printed:
+            printed.add(id(e))
+            print_enum(em, e)
+
+    if obj.descr or not shape:
+        em.i_print('(* {} *)'.format(obj.descr))
+
+    em.i_print('type t = {' if shape else 'datatype t = T of {')
+    fields = []
+    for prop_name,prop_type in obj.props.items():
+        fields.append('{}: {}'.format(prop_name, prop_type.s(name)))
+    em.indent += 2
+    em.i_print(',\n'.join(fields))
+    em.indent -= 2
+    em.i_print('}')
+
+    em.write('\n\n')
+
+    constants = sorted(set(e.constant() for e in nodes if isinstance(e, Enum) and e.constant() is not None))
+    for c in constants:
+        em.i_print('val {} = Json.STRING {}'.format(constant_binding(c), sml_string(c)))
+    fields, optional = record_fields(name, obj.props, 'x')
+    em.i_print('fun toJson {} = Json.OBJECT {}['.format(arg, '(List.concat ' if optional else ''))
+    em.indent += 2
+    em.i_print(',\n'.join(fields))
+    em.indent -= 2
+    em.i_print('])' if optional else ']')
+
+    em.i_print('fun writeJson b {} = ('.format(arg))
+    em.indent += 2
+    em.i_print(';\n'.join(record_writer(name, obj.props, 'x')) + ')')
+    em.indent -= 2
+    em.i_print('fun toJsonString x = JsonBuf.toString writeJson x')
+
+    em.i_print('fun readJson (p : JsonPull.t) : t = let')
+    decls, fields = record_reader(name, obj.props)
+    em.indent += 2
+    em.i_print('\n'.join(decls))
+    em.indent -= 2
+    em.i_print('in {}{{'.format(con))
+    em.indent += 2
+    em.i_print(',\n'.join(fields))
+    em.indent -= 2
+    em.i_print('} end')
+    em.i_print('fun fromJsonString s = JsonPull.decodeString readJson s')
+
+    em.i_print('fun fromJson (x : Json.value) : t = let')
+    decls, fields = record_decoder(name, obj.props)
+    em.indent += 2
+    em.i_print('\n'.join(decls))
+    em.indent -= 2
+    em.i_print('in {}{{'.format(con))
+    em.indent += 2
+    em.i_print(',\n'.join(fields))
+    em.indent -= 2
+    em.i_print('} end')
+
+    if not shape and is_request(obj) and set(obj.props) <= envelope_fields:
+        print_lazy_request(em, obj)
+
+    em.indent -= 2
+    em.i_print('end\n')
+
+envelope_fields = {'seq', 'type_', 'command', 'arguments'}
+
+def is_request(obj):
+    t = obj.props.get('type_', None) if hasattr(obj, 'props') else None
+    return isinstance(t, Enum) and t.constant() == 'request'
+
+def print_lazy_request(em, obj):
+    # A request whose arguments are only decoded when the handler forces them,
+    # until then they stay an undecoded slice of the input (or subtree).
+    em.i_print('datatype lazy = Lazy of Envelope.t')
+    em.i_print('fun envelope (Lazy env) = env')
+    em.i_print('fun force (Lazy env) : t = T {')
+    fields = []
+    for k,v in obj.props.items():
+        if k == 'arguments' and isinstance(v, Option):
+            fields.append('arguments=Envelope.optionalArguments ({}, fn x => {}) env'.format(v.read_json(obj.name), v.from_json(obj.name, 'x')))
+        elif k == 'arguments':
+            fields.append('arguments=Envelope.arguments ({}, fn x => {}) env'.format(v.read_json(obj.name), v.from_json(obj.name, 'x')))
         else:
-            i_print('| "{}" => {}'.format(e, e))
-    indent -= 2
-
-    indent -= 2
-    i_print('end\n')
-
-def create_converted(names):
-    import copy
-    unprocessed = copy.deepcopy(names)
-    failed = []
-    processed = {}
+            fields.append('{}=(#{} env)'.format(k, k))
+    em.indent += 2
+    em.i_print(',\n'.join(fields))
+    em.indent -= 2
+    em.i_print('}')
+
+
+sml_reserved = {
+    'abstype', 'and', 'andalso', 'as', 'case', 'datatype', 'do', 'else', 'end', 'eqtype', 'exception',
+    'fn', 'fun', 'functor', 'handle', 'if', 'in', 'include', 'infix', 'infixr', 'let', 'local',
+    'nonfix', 'of', 'op', 'open', 'orelse', 'raise', 'rec', 'sharing', 'sig', 'signature', 'struct',
+    'structure', 'then', 'type', 'val', 'where', 'while', 'with', 'withtype',
+    # not reserved, but rebinding them as constructors breaks the code around
+    'true', 'false', 'nil', 'ref', 'x', 'b', 'p', 's', 'v', 'match',
+}
+
+def enum_constructor(value):
+    # Values are used as constructors as far as SML allows, anything else
+    # is camel cased, reserved words get a trailing underscore.
+    words = ''.join(c if c.isalnum() or c == '_' else ' ' for c in value).split()
+    name = ''.join(w if i == 0 else upper_first(w) for i, w in enumerate(words))
+    if not name or not name[0].isalpha():
+        name = 'v' + name
+    if name in sml_reserved:
+        name += '_'
+    return name
+
+def print_enum(em, obj):
+    # Encoding goes through preallocated values and literals, decoding through
+    # a dispatch on the length and first character.
+    cons = [(v, enum_constructor(v)) for v in obj.values]
+    names = [c for _v, c in cons]
+    assert len(set(names)) == len(names) and 'Other' not in names, 'clashing constructors in {}'.format(obj.name)
+
+    em.i_print('structure {} = struct'.format(obj.binding))
+    em.indent += 2
+    em.i_print('(* {} *)'.format(obj.descr))
+
+    em.i_print('datatype t = ' + ' | '.join(names + (['Other of string'] if obj.open else [])))
+
+    em.write('\n\n')
+
+    for v, c in cons:
+        em.i_print('val json_{} = Json.STRING {}'.format(c, sml_string(v)))
+    em.i_print('fun toJson x = case x of')
+    em.indent += 2
+    arms = ['{} => json_{}'.format(c, c) for _v, c in cons]
+    if obj.open:
+        arms.append('Other s => Json.STRING s')
+    em.i_print('  ' + '\n| '.join(arms))
+    em.indent -= 2
+
+    em.i_print('fun writeJson b x = case x of')
+    em.indent += 2
+    arms = ['{} => JsonBuf.add (b, {})'.format(c, sml_string(json.dumps(v))) for v, c in cons]
+    if obj.open:
+        arms.append('Other s => JsonBuf.addString (b, s)')
+    em.i_print('  ' + '\n| '.join(arms))
+    em.indent -= 2
+    em.i_print('fun toJsonString x = JsonBuf.toString writeJson x')
+
+    em.i_print('fun match s = ' + length_char_dispatch(
+        [(v, 'SOME {}'.format(c)) for v, c in cons], 'Substring.size s', 'Substring.sub (s, 0)',
+        lambda v: 'JsonPull.keyIs (s, {})'.format(sml_string(v)), 'NONE'))
+
+    em.i_print('fun readJson p = let')
+    em.i_print('    val s = JsonPull.readStringSlice p')
+    em.i_print('  in')
+    em.i_print('    case match s of')
+    em.i_print('        SOME x => x')
+    if obj.open:
+        em.i_print('      | NONE => Other (Substring.string s)')
+    else:
+        em.i_print('      | NONE => JsonPull.fail (p, "unknown {}")'.format(obj.binding))
+    em.i_print('  end')
+    em.i_print('fun fromJsonString s = JsonPull.decodeString readJson s')
+
+    em.i_print('fun fromJson x = let')
+    em.i_print('    val s = JSONUtil.asString x')
+    em.i_print('  in')
+    em.i_print('    case match (Substring.full s) of')
+    em.i_print('        SOME v => v')
+    if obj.open:
+        em.i_print('      | NONE => Other s')
+    else:
+        em.i_print('      | NONE => raise JsonPull.Error ("unknown {}", 0)'.format(obj.binding))
+    em.i_print('  end')
+
+    em.indent -= 2
+    em.i_print('end')
+    em.write('\n')
+
+# Structures the generated records refer to besides the definitions, an inline
+# enum's structure must not shadow them.
+runtime_structures = {
+    'Json', 'JsonBuf', 'JsonPull', 'JSONUtil', 'Base64', 'MemoryRead', 'Option', 'Int', 'Real', 'String', 'Bool',
+    'Constant', 'NullableString', 'IntOrString', 'StringMap', 'Cancel', 'Envelope', 'Event', 'EventQueue',
+    'Handles', 'Events', 'List', 'Substring', 'Vector', 'Word8Vector', 'CharVector', 'Time',
+}
+
+def constant_binding(value):
+    # The name of the value holding a constant's Json.value, every character
+    # that cannot be part of an identifier is spelled out by its code.
+    return 'json_' + ''.join(c if c.isascii() and c.isalnum() else '_{}_'.format(ord(c)) for c in value)
+
+def inline_nodes(t, path=()):
+    # The nodes emitted as part of t's structure, with their property paths,
+    # shared nodes below t are yielded but not entered.
+    if isinstance(t, Option):
+        yield from inline_nodes(t.o, path)
+    elif isinstance(t, (Array, StringMap)):
+        yield from inline_nodes(t.e, path)
+    elif isinstance(t, (Enum, Record)):
+        if path:
+            yield t, path
+        if isinstance(t, Record) and (t.shared is None or not path):
+            for k, v in t.props.items():
+                yield from inline_nodes(v, path + (k,))
+
+def path_names(path):
+    return [upper_first(enum_constructor(field_name_to_prop.get(k, k))) for k in path]
+
+def pick_name(candidates, taken):
+    name = next((c for c in candidates if c not in taken), None)
+    i = 2
+    while name is None:
+        if candidates[-1] + str(i) not in taken:
+            name = candidates[-1] + str(i)
+        i += 1
+    taken.add(name)
+    return name
+
+def share_inline(converted):
+    # Inline records and enum datatypes that occur in more than one place
+    # become shared structures, added to converted under a name made of the
+    # definition and property they first occur in. The enums left get a
+    # structure inside the one they are emitted in, named after their
+    # property (and the enclosing properties when that is taken) so that it
+    # does not shadow the structures referred to there.
+    places = {}
+    first = []
+    def count(t, name, path, outer):
+        if isinstance(t, Option):
+            count(t.o, name, path, outer)
+        elif isinstance(t, (Array, StringMap)):
+            count(t.e, name, path, outer)
+        elif isinstance(t, Record) or (isinstance(t, Enum) and t.constant() is None):
+            if id(t) in places:
+                places[id(t)] += 1
+                return
+            places[id(t)] = 1
+            first.append((t, name, path, outer))
+            # a record is only entered once, what it contains occurs in more
+            # places only when it occurs outside of it too
+            if isinstance(t, Record):
+                inner = outer + ((t, len(path)),)
+                for k, v in t.props.items():
+                    count(v, name, path + (k,), inner)
+    for name, obj in converted.items():
+        if isinstance(obj, Record):
+            for k, v in obj.props.items():
+                count(v, name, (k,), ())
+
+    taken = set(converted) | runtime_structures
+    shared = {}
+    for node, name, path, _outer in first:
+        if places[id(node)] > 1:
+            names = path_names(path)
+            node.shared = pick_name([name + names[-1], name + ''.join(names)], taken)
+            if isinstance(node, Enum):
+                node.binding = node.shared
+            shared[node.shared] = node
+    converted.update(shared)
+
+    taken = {}
+    for node, name, path, outer in first:
+        if not isinstance(node, Enum) or node.shared is not None:
+            continue
+        # emitted in the innermost shared record around it, if any
+        owner, start = name, 0
+        for rec, depth in outer:
+            if rec.shared is not None:
+                owner, start = rec.shared, depth
+        if owner not in taken:
+            taken[owner] = converted[owner].structure_deps() | runtime_structures
+        names = path_names(path[start:])
+        node.owner = owner
+        node.binding = pick_name([''.join(names[-i:]) for i in range(1, len(names) + 1)], taken[owner])
+    return converted
+
+def mark_bytes(definitions):
+    # a copy of definitions with contentEncoding on the bytes_fields, only the
+    # schemas along their paths are copied
+    definitions = dict(definitions)
+    for name, *path in bytes_fields:
+        if name not in definitions:
+            continue
+        schem = definitions[name] = dict(definitions[name])
+        for prop in path:
+            # the property is declared in the schema itself or in one of its allOf parts
+            parts = [schem] + schem.get('allOf', [])
+            owner = next((o for o in parts if prop in o.get('properties', {})), None)
+            if owner is None:
+                raise KeyError('{}: no property {}'.format(name, prop))
+            if owner is not schem:
+                i = schem['allOf'].index(owner)
+                schem['allOf'] = list(schem['allOf'])
+                owner = schem['allOf'][i] = dict(owner)
+            owner['properties'] = dict(owner['properties'])
+            schem = owner['properties'][prop] = dict(owner['properties'][prop])
+        schem['contentEncoding'] = 'base64'
+    return definitions
+
+def create_converted(definitions):
+    resolver = Resolver(mark_bytes(definitions))
+    for name in definitions:
+        resolver.resolve(name)
+    return share_inline(resolver.converted)
+
+header = r'''
 
-    while len(failed)!=0 or len(unprocessed)!=0:
-        while len(unprocessed)!=0:
-            current_name = unprocessed.pop()
-            try:
-                processed[current_name] = make(processed, current_name, dap_json['definitions'][current_name])
-            except UnknownRefException as e:
-                failed.append(current_name)
+structure Json = JSON
 
-        unprocessed = failed
-        failed = []
+fun id x = x
 
-    return processed
+fun vectorToList vec = Vector.foldr (op ::) [] vec
 
-header = '''
+fun slot () : Json.value option ref = ref NONE
+
+fun objectFields x = case x of
+    Json.OBJECT fs => fs
+  | _ => raise JSONUtil.NotObject x
+
+fun required x name r = case !r of
+    SOME v => v
+  | NONE => raise JSONUtil.FieldNotFound (x, name)
+
+(* A growable character buffer that JSON is written into directly, without
+ * building a Json.value first. *)
+structure JsonBuf = struct
+  type t = {buf : CharArray.array ref, len : int ref}
+
+  fun new n : t = {buf = ref (CharArray.array (Int.max (n, 16), #"\000")), len = ref 0}
+
+  fun reserve ({buf, len} : t, n) =
+    if !len + n <= CharArray.length (!buf) then ()
+    else let
+      val b = CharArray.array (Int.max (2 * CharArray.length (!buf), !len + n), #"\000")
+    in
+      CharArraySlice.copy {src = CharArraySlice.slice (!buf, 0, SOME (!len)), dst = b, di = 0};
+      buf := b
+    end
+
+  fun addChar (b as {buf, len} : t, c) = (
+    reserve (b, 1);
+    CharArray.update (!buf, !len, c);
+    len := !len + 1)
+
+  fun addSlice (b as {buf, len} : t, s, i, n) = (
+    reserve (b, n);
+    CharArraySlice.copyVec {src = CharVectorSlice.slice (s, i, SOME n), dst = !buf, di = !len};
+    len := !len + n)
+
+  fun add (b, s) = addSlice (b, s, 0, String.size s)
+
+  (* an object key, with the separator unless it is the object's first *)
+  fun addKey (b as {buf, len} : t, key) = (
+    if CharArray.sub (!buf, !len - 1) = #"{" then () else addChar (b, #",");
+    add (b, key))
+
+  fun length ({len, ...} : t) = !len
+
+  fun clear ({len, ...} : t) = len := 0
+
+  fun contents ({buf, len} : t) = CharArraySlice.vector (CharArraySlice.slice (!buf, 0, SOME (!len)))
+
+  fun output (strm, {buf, len} : t) =
+    TextIO.output (strm, CharArraySlice.vector (CharArraySlice.slice (!buf, 0, SOME (!len))))
+
+  (* escape sequence per character, "" for characters that are copied as is *)
+  val escapes = Vector.tabulate (256, fn i =>
+      case Char.chr i of
+          #"\"" => "\\\""
+        | #"\\" => "\\\\"
+        | #"\n" => "\\n"
+        | #"\r" => "\\r"
+        | #"\t" => "\\t"
+        | #"\b" => "\\b"
+        | #"\f" => "\\f"
+        | _ => if i < 32 then "\\u00" ^ StringCvt.padLeft #"0" 2 (Int.fmt StringCvt.HEX i) else "")
+
+  (* runs of characters that need no escaping are copied in one go *)
+  fun addString (b, s) = let
+      val n = String.size s
+      fun loop (start, i) =
+        if i = n then addSlice (b, s, start, i - start)
+        else let
+          val e = Vector.sub (escapes, Char.ord (String.sub (s, i)))
+        in
+          if String.size e = 0 then loop (start, i + 1)
+          else (addSlice (b, s, start, i - start); add (b, e); loop (i + 1, i + 1))
+        end
+    in
+      addChar (b, #"\"");
+      loop (0, 0);
+      addChar (b, #"\"")
+    end
+
+  fun minus c = if c = #"~" then #"-" else c
+
+  fun addInt (b, i) = add (b, if i < 0 then String.map minus (Int.toString i) else Int.toString i)
+
+  fun addIntInf (b, i) = add (b, if i < 0 then String.map minus (IntInf.toString i) else IntInf.toString i)
+
+  (* JSON has no inf or nan, they are written as null *)
+  fun addReal (b, r) =
+    if Real.isFinite r then add (b, String.map minus (Real.fmt (StringCvt.GEN (SOME 17)) r))
+    else add (b, "null")
+
+  fun addBool (b, x) = add (b, if x then "true" else "false")
+
+  fun addList b w xs = let
+      fun loop [] = ()
+        | loop (x :: xs) = (addChar (b, #","); w x; loop xs)
+    in
+      addChar (b, #"[");
+      (case xs of [] => () | x :: xs => (w x; loop xs));
+      addChar (b, #"]")
+    end
+
+  fun addFields b w fs = let
+      fun field (k, v) = (addString (b, k); addChar (b, #":"); w v)
+      fun loop [] = ()
+        | loop (f :: fs) = (addChar (b, #","); field f; loop fs)
+    in
+      addChar (b, #"{");
+      (case fs of [] => () | f :: fs => (field f; loop fs));
+      addChar (b, #"}")
+    end
+
+  fun addValue b v = case v of
+      Json.OBJECT fs => addFields b (addValue b) fs
+    | Json.ARRAY vs => addList b (addValue b) vs
+    | Json.NULL => add (b, "null")
+    | Json.BOOL x => addBool (b, x)
+    | Json.INT i => addIntInf (b, i)
+    | Json.FLOAT r => addReal (b, r)
+    | Json.STRING s => addString (b, s)
+
+  fun toString w x = let
+      val b = new 256
+    in
+      w b x;
+      contents b
+    end
+end
 
-structure Json = JSON
+(* A pull parser over a slice of a string. Generated readJson functions use it
+ * to decode straight into records, without building a Json.value first. *)
+structure JsonPull = struct
+  exception Error of string * int
+
+  type t = {src : string, pos : int ref, stop : int}
+
+  fun fromSlice (src, i, n) : t = {src = src, pos = ref i, stop = i + n}
+
+  fun fromString s = fromSlice (s, 0, String.size s)
+
+  fun fail ({pos, ...} : t, msg) = raise Error (msg, !pos)
+
+  fun isSpace c = c = #" " orelse c = #"\n" orelse c = #"\r" orelse c = #"\t"
+
+  fun isNumChar c = Char.isDigit c orelse c = #"-" orelse c = #"+" orelse c = #"."
+    orelse c = #"e" orelse c = #"E"
+
+  (* next significant character, #"\000" at the end of the input *)
+  fun peek ({src, pos, stop} : t) = let
+      fun loop i = if i < stop andalso isSpace (String.sub (src, i)) then loop (i + 1) else i
+      val i = loop (!pos)
+    in
+      pos := i;
+      if i < stop then String.sub (src, i) else #"\000"
+    end
+
+  fun advance ({pos, ...} : t) = pos := !pos + 1
+
+  fun expect (p, c) = if peek p = c then advance p else fail (p, "expected " ^ String.str c)
+
+  fun literal (p as {src, pos, stop} : t, s) = let
+      val _ = peek p
+      val n = String.size s
+      fun loop j = j = n orelse (String.sub (src, !pos + j) = String.sub (s, j) andalso loop (j + 1))
+    in
+      if !pos + n <= stop andalso loop 0 then pos := !pos + n else fail (p, "expected " ^ s)
+    end
+
+  (* end of the string body starting at i (the index of the closing quote) and
+   * whether it contains escapes *)
+  fun scanString (p as {src, stop, ...} : t, i) = let
+      fun loop (j, esc) =
+        if j >= stop then fail (p, "unterminated string")
+        else case String.sub (src, j) of
+            #"\"" => (j, esc)
+          | #"\\" => loop (j + 2, true)
+          | _ => loop (j + 1, esc)
+    in
+      loop (i, false)
+    end
+
+  fun unescape (p as {src, ...} : t, i, j) = let
+      fun hex k = case StringCvt.scanString (Int.scan StringCvt.HEX) (String.substring (src, k, 4)) of
+          SOME v => v
+        | NONE => fail (p, "bad \\u escape")
+      fun enc (cp, acc) =
+        if cp < 0x80 then Char.chr cp :: acc
+        else if cp < 0x800 then
+          Char.chr (0x80 + cp mod 64) :: Char.chr (0xC0 + cp div 64) :: acc
+        else if cp < 0x10000 then
+          Char.chr (0x80 + cp mod 64) :: Char.chr (0x80 + (cp div 64) mod 64)
+            :: Char.chr (0xE0 + cp div 4096) :: acc
+        else
+          Char.chr (0x80 + cp mod 64) :: Char.chr (0x80 + (cp div 64) mod 64)
+            :: Char.chr (0x80 + (cp div 4096) mod 64) :: Char.chr (0xF0 + cp div 262144) :: acc
+      fun loop (k, acc) =
+        if k >= j then String.implode (List.rev acc)
+        else case String.sub (src, k) of
+            #"\\" => (case String.sub (src, k + 1) of
+                #"n" => loop (k + 2, #"\n" :: acc)
+              | #"t" => loop (k + 2, #"\t" :: acc)
+              | #"r" => loop (k + 2, #"\r" :: acc)
+              | #"b" => loop (k + 2, #"\b" :: acc)
+              | #"f" => loop (k + 2, #"\f" :: acc)
+              | #"u" => let
+                  val cp = hex (k + 2)
+                in
+                  if cp >= 0xD800 andalso cp < 0xDC00 andalso k + 12 <= j
+                     andalso String.sub (src, k + 6) = #"\\" andalso String.sub (src, k + 7) = #"u"
+                  then loop (k + 12, enc (0x10000 + (cp - 0xD800) * 1024 + (hex (k + 8) - 0xDC00), acc))
+                  else loop (k + 6, enc (cp, acc))
+                end
+              | c => loop (k + 2, c :: acc))
+          | c => loop (k + 1, c :: acc)
+    in
+      loop (i, [])
+    end
+
+  (* the string body, sharing the input when it has no escapes *)
+  fun readStringSlice (p as {src, pos, ...} : t) = let
+      val () = expect (p, #"\"")
+      val i = !pos
+      val (j, esc) = scanString (p, i)
+    in
+      pos := j + 1;
+      if esc then Substring.full (unescape (p, i, j)) else Substring.substring (src, i, j - i)
+    end
+
+  fun readString p = Substring.string (readStringSlice p)
+
+  fun keyIs (k, s) = Substring.size k = String.size s andalso Substring.isPrefix s k
+
+  fun numberEnd ({src, stop, ...} : t, i) = let
+      fun loop k = if k < stop andalso isNumChar (String.sub (src, k)) then loop (k + 1) else k
+    in
+      loop i
+    end
+
+  fun readInt (p as {src, pos, stop} : t) = let
+      val _ = peek p
+      val i = !pos
+      val neg = i < stop andalso String.sub (src, i) = #"-"
+      val start = if neg then i + 1 else i
+      (* accumulated negated so the most negative int can be read *)
+      fun loop (k, acc) =
+        if k < stop andalso Char.isDigit (String.sub (src, k))
+        then loop (k + 1, acc * 10 - (Char.ord (String.sub (src, k)) - 48))
+        else (k, acc)
+      val (k, acc) = loop (start, 0)
+    in
+      if k = start orelse (k < stop andalso isNumChar (String.sub (src, k)))
+      then fail (p, "expected an integer")
+      else (pos := k; if neg then acc else ~ acc)
+    end
+
+  fun readNumber (p as {src, pos, ...} : t) = let
+      val _ = peek p
+      val i = !pos
+      val k = numberEnd (p, i)
+    in
+      case Real.fromString (String.substring (src, i, k - i)) of
+          SOME r => (pos := k; r)
+        | NONE => fail (p, "expected a number")
+    end
+
+  fun readBool p = case peek p of
+      #"t" => (literal (p, "true"); true)
+    | #"f" => (literal (p, "false"); false)
+    | _ => fail (p, "expected a boolean")
+
+  fun isNull p = peek p = #"n" andalso (literal (p, "null"); true)
+
+  (* calls field with each key, field has to consume the value *)
+  fun object p field = let
+      val () = expect (p, #"{")
+      fun loop () = let
+          val k = readStringSlice p
+          val () = expect (p, #":")
+          val () = field k
+        in
+          case peek p of
+              #"," => (advance p; loop ())
+            | #"}" => advance p
+            | _ => fail (p, "expected , or }")
+        end
+    in
+      if peek p = #"}" then advance p else loop ()
+    end
+
+  fun list r p = let
+      val () = expect (p, #"[")
+      fun loop acc = let
+          val acc = r p :: acc
+        in
+          case peek p of
+              #"," => (advance p; loop acc)
+            | #"]" => (advance p; List.rev acc)
+            | _ => fail (p, "expected , or ]")
+        end
+    in
+      if peek p = #"]" then (advance p; []) else loop []
+    end
+
+  fun members r p = let
+      val acc = ref []
+    in
+      object p (fn k => acc := (Substring.string k, r p) :: !acc);
+      List.rev (!acc)
+    end
+
+  (* skipping never copies anything out of the input *)
+  fun skipString (p as {pos, ...} : t) = let
+      val () = expect (p, #"\"")
+      val (j, _) = scanString (p, !pos)
+    in
+      pos := j + 1
+    end
+
+  fun skip (p as {pos, ...} : t) = case peek p of
+      #"{" => skipSeq (p, #"}", fn () => (skipString p; expect (p, #":"); skip p))
+    | #"[" => skipSeq (p, #"]", fn () => skip p)
+    | #"\"" => skipString p
+    | #"t" => literal (p, "true")
+    | #"f" => literal (p, "false")
+    | #"n" => literal (p, "null")
+    | c => if isNumChar c then pos := numberEnd (p, !pos) else fail (p, "unexpected character")
+
+  and skipSeq (p, close, elem) = let
+      fun loop () = (
+        elem ();
+        if peek p = #"," then (advance p; loop ()) else expect (p, close))
+    in
+      advance p;
+      if peek p = close then advance p else loop ()
+    end
+
+  (* the text of the next value, skipped over without being decoded *)
+  fun rawValue (p as {src, pos, ...} : t) = let
+      val _ = peek p
+      val i = !pos
+    in
+      skip p;
+      Substring.substring (src, i, !pos - i)
+    end
+
+  fun readValue (p as {src, pos, ...} : t) = case peek p of
+      #"{" => Json.OBJECT (members readValue p)
+    | #"[" => Json.ARRAY (list readValue p)
+    | #"\"" => Json.STRING (readString p)
+    | #"t" => Json.BOOL (readBool p)
+    | #"f" => Json.BOOL (readBool p)
+    | #"n" => (literal (p, "null"); Json.NULL)
+    | _ => let
+        val i = !pos
+        val k = numberEnd (p, i)
+        val s = String.substring (src, i, k - i)
+        val isFloat = CharVector.exists (fn c => c = #"." orelse c = #"e" orelse c = #"E") s
+      in
+        case (isFloat, if isFloat then NONE else IntInf.fromString s, Real.fromString s) of
+            (false, SOME i, _) => (pos := k; Json.INT i)
+          | (true, _, SOME r) => (pos := k; Json.FLOAT r)
+          | _ => fail (p, "expected a value")
+      end
+
+  fun required p name r = case !r of
+      SOME v => v
+    | NONE => fail (p, "missing field " ^ name)
+
+  fun finish (p as {pos, stop, ...} : t) = (peek p; if !pos = stop then () else fail (p, "trailing characters"))
+
+  fun decodeString r s = let
+      val p = fromString s
+      val v = r p
+    in
+      finish p;
+      v
+    end
+
+  fun decodeSlice r s = let
+      val p = fromSlice (Substring.base s)
+      val v = r p
+    in
+      finish p;
+      v
+    end
+end
 
-fun id x = x
+(* Base64 over bytes. Encoding looks up two output characters per 12 bits of
+ * input and writes straight into the JsonBuf, decoding maps each character
+ * through a 256 entry table into a preallocated array. Fields hold their bytes
+ * as a list of chunks, which are encoded in place one after the other. *)
+structure Base64 = struct
+  exception Invalid of int
+
+  val alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+  (* the two characters for every 12 bit value *)
+  val pairs = CharVector.tabulate (8192, fn i =>
+    CharVector.sub (alphabet, if i mod 2 = 0 then i div 128 else i div 2 mod 64))
+
+  (* 6 bit value of each character, ~1 outside the alphabet *)
+  val values = let
+      val a = Array.array (256, ~1)
+    in
+      CharVector.appi (fn (i, c) => Array.update (a, Char.ord c, i)) alphabet;
+      Array.vector a
+    end
+
+  fun encodedSize n = 4 * ((n + 2) div 3)
+
+  fun encodeInto (dst : CharArray.array, di, s : Word8VectorSlice.slice) = let
+      val (v, i, n) = Word8VectorSlice.base s
+      fun byte j = Word.fromInt (Word8.toInt (Word8Vector.sub (v, i + j)))
+      fun pair (k, x) = let
+          val x = 2 * Word.toInt x
+        in
+          CharArray.update (dst, k, CharVector.sub (pairs, x));
+          CharArray.update (dst, k + 1, CharVector.sub (pairs, x + 1))
+        end
+      fun bits w = Word.orb (Word.<< (byte w, 0w16), Word.orb (Word.<< (byte (w + 1), 0w8), byte (w + 2)))
+      fun loop (j, k) =
+        if j + 3 <= n then let
+            val w = bits j
+          in
+            pair (k, Word.>> (w, 0w12));
+            pair (k + 2, Word.andb (w, 0wxFFF));
+            loop (j + 3, k + 4)
+          end
+        else if j = n then ()
+        else let
+          val w = Word.<< (byte j, 0w16)
+          val w = if n - j = 2 then Word.orb (w, Word.<< (byte (j + 1), 0w8)) else w
+        in
+          pair (k, Word.>> (w, 0w12));
+          if n - j = 2 then CharArray.update (dst, k + 2, CharVector.sub (alphabet, Word.toInt (Word.andb (Word.>> (w, 0w6), 0wx3F))))
+          else CharArray.update (dst, k + 2, #"=");
+          CharArray.update (dst, k + 3, #"=")
+        end
+    in
+      loop (0, di)
+    end
+
+  fun addSlice (b as {buf, len} : JsonBuf.t, s) = let
+      val m = encodedSize (Word8VectorSlice.length s)
+    in
+      JsonBuf.reserve (b, m);
+      encodeInto (!buf, !len, s);
+      len := !len + m
+    end
+
+  fun encode v = let
+      val b = JsonBuf.new (encodedSize (Word8Vector.length v))
+    in
+      addSlice (b, Word8VectorSlice.full v);
+      JsonBuf.contents b
+    end
+
+  fun decodeSlice s = let
+      val (str, i, n) = Substring.base s
+      fun at j = String.sub (str, i + j)
+      val () = if n mod 4 = 0 then () else raise Invalid n
+      val pad = if n = 0 orelse at (n - 1) <> #"=" then 0 else if at (n - 2) = #"=" then 2 else 1
+      val out = Word8Array.array (n div 4 * 3 - pad, 0w0)
+      fun value j = let
+          val x = Vector.sub (values, Char.ord (at j))
+        in
+          if x < 0 then raise Invalid j else Word.fromInt x
+        end
+      fun put (k, w) = Word8Array.update (out, k, Word8.fromLarge (Word.toLarge w))
+      val full = if pad = 0 then n else n - 4
+      fun loop (j, k) =
+        if j < full then let
+            val w = Word.orb (Word.orb (Word.<< (value j, 0w18), Word.<< (value (j + 1), 0w12)),
+                              Word.orb (Word.<< (value (j + 2), 0w6), value (j + 3)))
+          in
+            put (k, Word.>> (w, 0w16));
+            put (k + 1, Word.>> (w, 0w8));
+            put (k + 2, w);
+            loop (j + 4, k + 3)
+          end
+        else k
+      val k = loop (0, 0)
+      val () =
+        if pad = 0 then ()
+        else let
+          val w = Word.orb (Word.<< (value full, 0w18), Word.<< (value (full + 1), 0w12))
+          val w = if pad = 1 then Word.orb (w, Word.<< (value (full + 2), 0w6)) else w
+        in
+          put (k, Word.>> (w, 0w16));
+          if pad = 1 then put (k + 1, Word.>> (w, 0w8)) else ()
+        end
+    in
+      Word8Array.vector out
+    end
+
+  fun decode s = decodeSlice (Substring.full s)
+
+  (* the chunks encoded as if they were one vector, only the up to two bytes
+   * of a group of three that a chunk boundary splits are copied *)
+  fun addChunks (b, chunks) = let
+      fun loop (carry, []) = addSlice (b, Word8VectorSlice.full carry)
+        | loop (carry, v :: vs) = let
+            val n = Word8Vector.length v
+            (* the bytes of v that complete the carried group *)
+            val k = Int.min ((3 - Word8Vector.length carry) mod 3, n)
+            val carry = Word8Vector.concat [carry, Word8VectorSlice.vector (Word8VectorSlice.slice (v, 0, SOME k))]
+          in
+            if Word8Vector.length carry mod 3 <> 0 then loop (carry, vs)
+            else let
+              val whole = k + (n - k) div 3 * 3
+            in
+              addSlice (b, Word8VectorSlice.full carry);
+              addSlice (b, Word8VectorSlice.slice (v, k, SOME (whole - k)));
+              loop (Word8VectorSlice.vector (Word8VectorSlice.slice (v, whole, NONE)), vs)
+            end
+          end
+    in
+      loop (Word8Vector.fromList [], chunks)
+    end
+
+  fun toJson chunks = let
+      val b = JsonBuf.new (encodedSize (List.foldl (fn (v, n) => Word8Vector.length v + n) 0 chunks))
+    in
+      addChunks (b, chunks);
+      Json.STRING (JsonBuf.contents b)
+    end
+
+  fun writeJson b chunks = (
+    JsonBuf.addChar (b, #"\"");
+    addChunks (b, chunks);
+    JsonBuf.addChar (b, #"\""))
+
+  fun readJson p = [decodeSlice (JsonPull.readStringSlice p)]
+    handle Invalid _ => JsonPull.fail (p, "invalid base64")
+
+  fun fromJson x = [decode (JSONUtil.asString x)]
+end
 
-fun vectorToList vec = Vector.foldr (op ::) [] vec
+(* Reads a memory range in chunks of at most chunk bytes. read (offset, n)
+ * returns the readable bytes from offset, fewer than n when an unreadable
+ * region starts within the chunk, and Unreadable with the length of that region
+ * when it starts at offset. Reading stops at the first unreadable region, whose
+ * length within the range is reported as unreadableBytes. The chunks are
+ * returned as read, they are what the data field of a ReadMemoryResponse
+ * holds. *)
+structure MemoryRead = struct
+  datatype chunk = Bytes of Word8Vector.vector | Unreadable of int
+
+  fun read {chunk, count, read} = let
+      fun loop (offset, acc) =
+        if offset >= count then (acc, 0)
+        else case read (offset, Int.min (chunk, count - offset)) of
+            Bytes v => if Word8Vector.length v = 0 then (acc, count - offset) else loop (offset + Word8Vector.length v, v :: acc)
+          | Unreadable n => (acc, Int.min (Int.max (n, 0), count - offset))
+      val (parts, unreadable) = loop (0, [])
+    in
+      {data = rev parts, unreadableBytes = unreadable}
+    end
+end
 
 structure Option = struct
+  open Option
+
   fun toJson (f,v) = case v of
       NONE => Json.NULL
     | SOME v' => f v'
 
+  fun writeJson b w v = case v of
+      NONE => JsonBuf.add (b, "null")
+    | SOME v' => w v'
+
   fun fromJson (f,v) = case v of
       Json.NULL => NONE
     | _ => f v
+
+  fun readJson r p = if JsonPull.isNull p then NONE else SOME (r p)
+
+  (* the field of an object, left out when the value is NONE *)
+  fun field (name, f) v = case v of
+      NONE => []
+    | SOME v' => [(name, f v')]
+
+  fun fromField f r = case !r of
+      NONE => NONE
+    | SOME v => fromJson (f, v)
 end
 
 structure Int = struct
+  open Int
   type t = int
   
   fun toJson x = Json.INT (IntInf.fromInt x)
+
+  fun writeJson b x = JsonBuf.addInt (b, x)
+
+  fun readJson p = JsonPull.readInt p
 end
 
 structure Real = struct
+  open Real
   type t = real
   
-  fun toJson x = Json.FLOAT x
+  fun toJson x = if isFinite x then Json.FLOAT x else Json.NULL
+
+  fun writeJson b x = JsonBuf.addReal (b, x)
+
+  fun readJson p = JsonPull.readNumber p
 end
 
 structure String = struct
+  open String
   type t = string
   
   fun toJson x = Json.STRING x
+
+  fun writeJson b x = JsonBuf.addString (b, x)
+
+  fun readJson p = JsonPull.readString p
 end
 
 structure Bool = struct
+  open Bool
   type t = bool
   
   fun toJson x = Json.BOOL x
+
+  fun writeJson b x = JsonBuf.addBool (b, x)
+
+  fun readJson p = JsonPull.readBool p
+end
+
+(* The value of an enum with a single value, e.g. the type of a request. It
+ * stays a string, reading it only checks that it is the one allowed. *)
+structure Constant = struct
+  fun readJson s p = let
+      val k = JsonPull.readStringSlice p
+    in
+      if JsonPull.keyIs (k, s) then s else JsonPull.fail (p, "expected \"" ^ s ^ "\"")
+    end
+
+  fun fromJson s x =
+    if JSONUtil.asString x = s then s else raise JsonPull.Error ("expected \"" ^ s ^ "\"", 0)
 end
 
 structure NullableString = struct
@@ -767,9 +2084,15 @@ structure NullableString = struct
       SOME s => String.toJson s
     | NONE => Json.NULL
 
+  fun writeJson b x = case x of
+      SOME s => JsonBuf.addString (b, s)
+    | NONE => JsonBuf.add (b, "null")
+
   fun fromJson x = case x of
       Json.NULL => NONE
     | x => SOME (JSONUtil.asString x)
+
+  fun readJson p = if JsonPull.isNull p then NONE else SOME (JsonPull.readString p)
 end
 
 structure IntOrString = struct
@@ -779,8 +2102,14 @@ structure IntOrString = struct
       IsInt i => Int.toJson i
     | IsString s => String.toJson s
 
+  fun writeJson b x = case x of
+      IsInt i => JsonBuf.addInt (b, i)
+    | IsString s => JsonBuf.addString (b, s)
+
   fun fromJson x = (IsInt (JSONUtil.asInt x))
         handle JSONUtil.NotInt a => (IsString (JSONUtil.asString x))
+
+  fun readJson p = if JsonPull.peek p = #"\"" then IsString (JsonPull.readString p) else IsInt (JsonPull.readInt p)
 end
 
 structure StringMap = struct
@@ -788,50 +2117,327 @@ structure StringMap = struct
 
     fun toJson f x = Json.OBJECT (List.map (fn (k,v) => (k,f v)) (list x))
 
+    fun writeJson b w x = JsonBuf.addFields b w (list x)
+
     fun fromJson f x = case x of
         Json.OBJECT ls => StringMap.fromList (List.map (fn (k,v) => (k,f v)) ls)
-end
-'''
 
-converted = create_converted(list(dap_json['definitions'].keys()))
-dep_graph = {}
-for name, obj in converted.items():
-    dep_graph[name] = obj.deps()
+    fun readJson r p = StringMap.fromList (JsonPull.members r p)
+end
 
-#for n,deps in dep_graph.items():
-#    print(n, deps)
-#exit(0)
+(* Cooperative cancellation, handlers poll their token and may give up with
+ * Cancelled once it is tripped. *)
+structure Cancel :> sig
+  exception Cancelled
+  type token
+  val new : unit -> token
+  val cancel : token -> unit
+  val isCancelled : token -> bool
+  val check : token -> unit
+end = struct
+  exception Cancelled
+  type token = bool ref
+  fun new () = ref false
+  fun cancel t = t := true
+  fun isCancelled t = !t
+  fun check t = if !t then raise Cancelled else ()
+end
 
-dep_ord_names = []
-for name_group in toposort.toposort(dep_graph):
-    dep_ord_names += list(name_group)
+(* The seq/type/command header of a protocol message, read in one pass over
+ * the message so it can be dispatched before the rest is decoded. *)
+structure Envelope = struct
+  (* arguments are kept undecoded, as a slice of the input or as a subtree *)
+  datatype arguments = Slice of Substring.substring | Tree of Json.value | Absent
+
+  type t = {seq : int, type_ : string, command : string, arguments : arguments}
+
+  (* a message that could not be decoded but whose seq could be read, it can
+   * still be answered with an error response *)
+  exception Malformed of t * string
+
+  (* seq and type are required, and command in a request *)
+  fun readJson p = let
+      val seq = ref NONE
+      val type_ = ref NONE
+      val command = ref NONE
+      val arguments = ref Absent
+      fun field k =
+        if JsonPull.keyIs (k, "seq") then seq := SOME (JsonPull.readInt p)
+        else if JsonPull.keyIs (k, "type") then type_ := SOME (JsonPull.readString p)
+        else if JsonPull.keyIs (k, "command") then command := SOME (JsonPull.readString p)
+        else if JsonPull.keyIs (k, "arguments") then arguments := Slice (JsonPull.rawValue p)
+        else JsonPull.skip p
+      val () = JsonPull.object p field
+      val type_ = JsonPull.required p "type" type_
+    in
+      {seq = JsonPull.required p "seq" seq, type_ = type_,
+       command = if type_ = "request" then JsonPull.required p "command" command else getOpt (!command, ""),
+       arguments = !arguments}
+    end
+
+  (* what can be read of a request that failed to decode, NONE without a seq
+   * or when it is not a request *)
+  fun salvage s = let
+      val p = JsonPull.fromString s
+      val seq = ref NONE
+      val type_ = ref "request"
+      val command = ref ""
+      fun field k =
+        if JsonPull.keyIs (k, "seq") then seq := SOME (JsonPull.readInt p)
+        else if JsonPull.keyIs (k, "type") then type_ := JsonPull.readString p
+        else if JsonPull.keyIs (k, "command") then command := JsonPull.readString p
+        else JsonPull.skip p
+    in
+      (JsonPull.object p field handle _ => ());
+      case (!seq, !type_) of
+          (SOME seq, "request") => SOME {seq = seq, type_ = "request", command = !command, arguments = Absent}
+        | _ => NONE
+    end
+
+  fun salvageTree x = let
+      fun str (k, default) = case JSONUtil.findField x k of SOME (Json.STRING s) => s | _ => default
+    in
+      case (JSONUtil.findField x "seq", str ("type", "request")) of
+          (SOME (Json.INT seq), "request") =>
+            SOME {seq = IntInf.toInt seq, type_ = "request", command = str ("command", ""), arguments = Absent}
+        | _ => NONE
+    end
+    handle _ => NONE
+
+  fun malformed (e, env) = let
+      val reason = case e of
+          JsonPull.Error (msg, _) => msg
+        | JSONUtil.FieldNotFound (_, name) => "missing field " ^ name
+        | _ => General.exnMessage e
+    in
+      case env of
+          SOME env => Malformed (env, reason)
+        | NONE => e
+    end
+
+  (* decodes the envelope of message s, raising Malformed when it is broken
+   * but can be answered *)
+  fun decode s = readJson (JsonPull.fromString s)
+    handle e => raise malformed (e, salvage s)
+
+  fun fromJson x = let
+      val seq = ref NONE
+      val type_ = ref NONE
+      val command = ref NONE
+      val arguments = ref Absent
+      fun field ("seq", v) = seq := SOME (JSONUtil.asInt v)
+        | field ("type", v) = type_ := SOME (JSONUtil.asString v)
+        | field ("command", v) = command := SOME (JSONUtil.asString v)
+        | field ("arguments", v) = arguments := Tree v
+        | field _ = ()
+      val () = List.app field (objectFields x)
+      val type_ = required x "type" type_
+    in
+      {seq = required x "seq" seq, type_ = type_,
+       command = if type_ = "request" then required x "command" command else getOpt (!command, ""),
+       arguments = !arguments}
+    end
+    handle e => raise malformed (e, salvageTree x)
+
+  fun arguments (r, f) ({arguments, ...} : t) = case arguments of
+      Slice s => JsonPull.decodeSlice r s
+    | Tree x => f x
+    | Absent => raise JsonPull.Error ("missing field arguments", 0)
+
+  (* for requests whose arguments are optional, r and f decode an option *)
+  fun optionalArguments (r, f) (env : t) = case #arguments env of
+      Absent => NONE
+    | _ => arguments (r, f) env
+
+  fun errorResponse ({seq, command, ...} : t, message) = Json.OBJECT [
+      ("seq", Json.INT 0),
+      ("type", Json.STRING "response"),
+      ("request_seq", Json.INT (IntInf.fromInt seq)),
+      ("success", Json.BOOL false),
+      ("command", Json.STRING command),
+      ("message", Json.STRING message),
+      ("body", Json.OBJECT [])
+    ]
+
+  fun errorResponseString ({seq, command, ...} : t, message) = let
+      val b = JsonBuf.new 128
+    in
+      JsonBuf.add (b, "{\"seq\":0,\"type\":\"response\",\"request_seq\":");
+      JsonBuf.addInt (b, seq);
+      JsonBuf.add (b, ",\"success\":false,\"command\":");
+      JsonBuf.addString (b, command);
+      JsonBuf.add (b, ",\"message\":");
+      JsonBuf.addString (b, message);
+      (* ErrorResponse requires a body, its error field is optional *)
+      JsonBuf.add (b, ",\"body\":{}}");
+      JsonBuf.contents b
+    end
+end
 
-msgs = {'requests':{}, 'events':{}}
+(* An event on its way out. It is only rendered when it is sent, which is when
+ * its seq is known. *)
+structure Event = struct
+  datatype t =
+      Plain of int -> string
+      (* key names the stream the text belongs to, output with equal keys can
+       * be sent as one event *)
+    | Output of {key : string, text : string, render : int * string -> string}
+      (* only the latest update of a progress is of interest *)
+    | Progress of {id : string, render : int -> string}
+
+  type channel = t -> unit
+end
 
-for name, schem in converted.items():
-    if hasattr(schem, 'props'):
-        t = schem.props.get('type_', None)
-        if isinstance(t, Enum) and t.values == {'request'}:
-            assert name.endswith('Request')
-            name = name[0:-len('Request')]
-            if name=='':
-                continue
-            if name in msgs['requests']:
-                msgs['requests'][name]['req'] = schem
-            else:
-                msgs['requests'][name] = {'req':schem}
-        if isinstance(t, Enum) and t.values == {'response'}:
-            assert name.endswith('Response')
-            name = name[0:-len('Response')]
-            if name=='':
-                continue
-            if name in msgs['requests']:
-                msgs['requests'][name]['resp'] = schem
-            else:
-                msgs['requests'][name] = {'resp':schem}
+(* Holds back output and progress updates so that runs of them go out as few
+ * events. Consecutive output with the same key is merged until maxBytes of
+ * text are pending, a progress update replaces the pending one for the same
+ * progress. Anything else, or maxDelay passing since the first pending event,
+ * sends what is pending. *)
+structure EventQueue = struct
+  datatype pending =
+      (* the text in reverse *)
+      Text of {key : string, text : string list, render : int * string -> string}
+    | Update of {id : string, render : int -> string}
+
+  type t = {
+    seq : int ref,
+    (* newest first *)
+    pending : pending list ref,
+    bytes : int ref,
+    since : Time.time ref,
+    maxBytes : int,
+    maxDelay : Time.time
+  }
+
+  fun new {maxBytes, maxDelay} : t =
+    {seq = ref 1, pending = ref [], bytes = ref 0, since = ref Time.zeroTime, maxBytes = maxBytes, maxDelay = maxDelay}
+
+  fun next ({seq, ...} : t) = !seq before seq := !seq + 1
+
+  fun flush (q as {pending, bytes, ...} : t) sink = let
+      fun send (Text {text, render, ...}) = sink (render (next q, String.concat (rev text)))
+        | send (Update {render, ...}) = sink (render (next q))
+    in
+      List.app send (rev (!pending));
+      pending := [];
+      bytes := 0
+    end
+
+  fun add (q as {pending, bytes, since, maxBytes, maxDelay, ...} : t) sink ev = let
+      fun hold p = (
+        if List.null (!pending) then since := Time.now () else ();
+        pending := p)
+      fun isUpdate id (Update u) = #id u = id
+        | isUpdate _ _ = false
+    in
+      (case (ev, !pending) of
+          (Event.Plain render, _) => (flush q sink; sink (render (next q)))
+        | (Event.Output {key, text, render}, Text t :: rest) =>
+            if #key t = key then pending := Text {key = key, text = text :: #text t, render = render} :: rest
+            else hold (Text {key = key, text = [text], render = render} :: !pending)
+        | (Event.Output {key, text, render}, ps) => hold (Text {key = key, text = [text], render = render} :: ps)
+        | (Event.Progress {id, render}, ps) => hold (Update {id = id, render = render} :: List.filter (not o isUpdate id) ps));
+      (case ev of
+          Event.Output {text, ...} => bytes := !bytes + size text
+        | _ => ());
+      if List.null (!pending) then ()
+      else if !bytes >= maxBytes orelse Time.>= (Time.- (Time.now (), !since), maxDelay) then flush q sink
+      else ()
+    end
+end
 
-#print(msgs)
-#exit(0)
+(* The variablesReference handles given out while the debuggee is stopped.
+ *
+ * A handle maps to a container whose children are only produced when the
+ * client asks for them, indexed children one start/count window at a time.
+ * Handles carry the generation they were made in, invalidate starts a new
+ * generation (on continue or stopped) without touching the old entries, and
+ * handles from an older generation are no longer found. The low indexBits of a
+ * handle are its slot, the bits above the generation modulo generations, so
+ * every handle stays below 2^31. Slots keep counting up across generations
+ * and only start over at 0 once they run out, so a stale handle only resolves
+ * again when both the generation and the slots have come round to it. *)
+structure Handles = struct
+  datatype filter = Indexed | Named | All
+
+  type 'a container = {
+    named : unit -> 'a list,
+    indexed : int,
+    (* at most count indexed children, from start *)
+    slice : int * int -> 'a list
+  }
+
+  type 'a t = {
+    generation : int ref,
+    (* slot of the generation's first entry *)
+    base : int ref,
+    entries : 'a container option array ref,
+    count : int ref
+  }
+
+  val indexBits = 22
+  val limit = Word.toInt (Word.<< (0w1, Word.fromInt indexBits))
+  val generations = 512
+
+  fun new () : 'a t = {generation = ref 0, base = ref 0, entries = ref (Array.array (64, NONE)), count = ref 0}
+
+  fun invalidate ({generation, base, entries, count} : 'a t) = (
+    generation := (!generation + 1) mod generations;
+    base := (if !base + !count + 1 >= limit then 0 else !base + !count);
+    entries := Array.array (64, NONE);
+    count := 0)
+
+  (* a handle for c, 0 (no children) once the slots run out *)
+  fun add ({generation, base, entries, count} : 'a t, c : 'a container) = let
+      val i = !count
+      val old = !entries
+    in
+      if !base + i + 1 >= limit then 0
+      else (
+        if i < Array.length old then ()
+        else let
+          val grown = Array.array (2 * Array.length old, NONE)
+        in
+          Array.copy {src = old, dst = grown, di = 0};
+          entries := grown
+        end;
+        Array.update (!entries, i, SOME c);
+        count := i + 1;
+        !generation * limit + !base + i + 1)
+    end
+
+  fun get ({generation, base, entries, count} : 'a t, h) = let
+      val i = h mod limit - 1 - !base
+    in
+      if h > 0 andalso h div limit = !generation andalso i >= 0 andalso i < !count
+      then Array.sub (!entries, i)
+      else NONE
+    end
+
+  (* indexed children come from element, only for the windows asked for *)
+  fun container {named, indexed, element} : 'a container =
+    {named = named, indexed = indexed, slice = fn (start, count) => List.tabulate (count, fn i => element (start + i))}
+
+  fun filterOf s = case s of
+      "indexed" => Indexed
+    | "named" => Named
+    | _ => All
+
+  (* the children of handle h for a variables request, a count of 0 means all
+   * from start. NONE for a handle that is gone. *)
+  fun variables (t, h, {filter, start, count}) = case get (t, h) of
+      NONE => NONE
+    | SOME {named, indexed, slice} => let
+        val start = Int.max (0, Int.min (start, indexed))
+        val count = if count <= 0 then indexed - start else Int.min (count, indexed - start)
+      in
+        SOME (case filter of
+            Named => named ()
+          | Indexed => slice (start, count)
+          | All => named () @ slice (start, count))
+      end
+end
+'''
 
 def upper_first(s):
     return s[0].upper() + s[1:]
@@ -839,54 +2445,616 @@ def upper_first(s):
 def lower_first(s):
     return s[0].lower() + s[1:]
 
-def print_handle_sig(requests):
+def print_handle_sig(em, requests, lazy=False):
     sig_template = '''
 signature HANDLERS = sig
 {}
 end
 '''
-    handlers_sig = ['    val handle{} : {}.t -> {}.t'.format(upper_first(name), upper_first(name)+'Request', upper_first(name)+'Response') for name in requests.keys()]
+    arg = 'lazy' if lazy else 't'
+    handlers_sig = ['    val handle{} : Cancel.token -> {}.{} -> {}.t'.format(upper_first(name), upper_first(name)+'Request', arg, upper_first(name)+'Response') for name in requests.keys()]
     handle_sig = '\n'.join(handlers_sig)
-    i_print(sig_template.format(handle_sig))
+    em.i_print(sig_template.format(handle_sig))
+
+def length_char_dispatch(items, size, char, test, miss):
+    # Case on the length and the first character of a string, a single
+    # comparison then confirms the match. items are (string, result) pairs.
+    groups = {}
+    for text, result in items:
+        groups.setdefault(len(text), {}).setdefault(text[:1], []).append((text, result))
 
-def print_handler(requests):
+    lines = ['case {} of'.format(size)]
+    first = True
+    for length in sorted(groups):
+        by_char = groups[length]
+        if length == 0:
+            lines.append('{} 0 => {}'.format('   ' if first else '  |', by_char[''][0][1]))
+            first = False
+            continue
+        lines.append('{} {} => (case {} of'.format('   ' if first else '  |', length, char))
+        first = False
+        for j, c in enumerate(sorted(by_char)):
+            tests = ' else '.join('if {} then {}'.format(test(text), result) for text, result in by_char[c])
+            lines.append('{}#{} => {} else {}'.format('        ' if j == 0 else '      | ', sml_string(c), tests, miss))
+        lines.append('      | _ => {})'.format(miss))
+    lines.append('  | _ => {}'.format(miss) if groups else '    _ => {}'.format(miss))
+    return '\n'.join(lines)
+
+def command_index(commands):
+    # Index 0 means unknown command.
+    items = [(command, i + 1) for i, command in enumerate(commands)]
+    return 'fun commandIndex cmd = ' + length_char_dispatch(
+        items, 'size cmd', 'CharVector.sub (cmd, 0)', lambda c: 'cmd = "{}"'.format(c), 0)
+
+def print_handler(em, requests, lazy=False):
     handleRequestTemplate ='''
-functor DebugAdapterProtocol(structure Handlers : HANDLERS) :> sig val handleProtocolMessage : Json.value -> Json.value end = struct
+functor DebugAdapterProtocol(structure Handlers : HANDLERS) :> sig
+    exception Unhandled of string
+    val handleProtocolMessage : Json.value -> Json.value
+    val handleMessageString : string -> string
+    val handleRequestString : Cancel.token -> Envelope.t -> string -> string
+  end = struct
     open Handlers
-    fun handleRequest req = case JSONUtil.asString (JSONUtil.lookupField req "command") of
+
+    exception Unhandled of string
+
+    {}
+
+    fun handleRequest token (env : Envelope.t) msg = case commandIndex (#command env) of
         {}
 
-    fun handleProtocolMessage msg = case JSONUtil.asString (JSONUtil.lookupField msg "type") of
-          "request" => handleRequest msg
-      (*| "event"   => handleEvent msg
-        | _ => TextIO.print ("Unhandled protocolMessage: " ^ Json.toString msg) *)
+    fun handleRequestString token (env : Envelope.t) s = case commandIndex (#command env) of
+        {}
+
+    (* a request without seq, type or command is answered as malformed *)
+    fun handleProtocolMessage msg = let
+        val env = Envelope.fromJson msg
+      in
+        case #type_ env of
+            "request" => handleRequest (Cancel.new ()) env msg
+          | t => raise Unhandled t
+      end
+      handle Envelope.Malformed (env, reason) => Envelope.errorResponse (env, "malformed request: " ^ reason)
+
+    fun handleMessageString s = let
+        val env = Envelope.decode s
+      in
+        case #type_ env of
+            "request" => handleRequestString (Cancel.new ()) env s
+          | t => raise Unhandled t
+      end
+      handle Envelope.Malformed (env, reason) => Envelope.errorResponseString (env, "malformed request: " ^ reason)
 end
 '''
-    handlers = ['"{}" => {}.toJson (handle{} ({}.fromJson req))'.format(lower_first(name), upper_first(name)+'Response', upper_first(name), upper_first(name)+'Request') for name in requests.keys()]
+    names = list(requests.keys())
+    commands = [lower_first(name) for name in names]
+    index = command_index(commands).replace('\n', '\n    ')
+
+    # lazy handlers get the envelope and force the arguments themselves
+    request = '({}.Lazy env)' if lazy else '({}.fromJson msg)'
+    handlers = ['{} => {}.toJson (handle{} token {})'.format(i + 1, upper_first(name)+'Response', upper_first(name), request.format(upper_first(name)+'Request')) for i, name in enumerate(names)]
+    handlers.append('_ => Envelope.errorResponse (env, "unknown command")')
     handle = '\n      | '.join(handlers)
 
-    i_print(handleRequestTemplate.format(handle))
-    
-    handlerTemplate = '''
-'''
-    i_print(handlerTemplate)
+    request = '({}.Lazy env)' if lazy else '({}.fromJsonString s)'
+    handlers = ['{} => {}.toJsonString (handle{} token {})'.format(i + 1, upper_first(name)+'Response', upper_first(name), request.format(upper_first(name)+'Request')) for i, name in enumerate(names)]
+    handlers.append('_ => Envelope.errorResponseString (env, "unknown command")')
+    handle_string = '\n      | '.join(handlers)
 
-#print(dep_ord_names)
-#exit(0)
+    em.i_print(handleRequestTemplate.format(index, handle, handle_string))
 
-i_print(header)
-for name in dep_ord_names:
-    schem = converted[name]
-    if name in ignored_schems:
-        continue
+def event_record(name, obj, seq, body):
+    fields = []
+    for k, v in obj.props.items():
+        if k == 'seq':
+            fields.append('seq = {}'.format(seq))
+        elif k == 'body':
+            fields.append('body = {}'.format(body))
+        else:
+            fields.append('{} = {}'.format(k, sml_string(json.loads(v.json_constant()))))
+    return '{}.T {{{}}}'.format(name, ', '.join(fields))
+
+def print_events(em, events):
+    # Typed senders for every generated event. They post to a channel, which
+    # renders the event once it leaves the queue, that is when its seq is known.
+    # output and progressUpdate are posted so that the queue can coalesce them.
+    em.i_print('structure Events = struct')
+    em.indent += 2
+    for event, obj in sorted(events.items()):
+        name = obj.name
+        body = obj.props.get('body')
+        arg = 'body' if body is not None else '()'
+        fields = body.props if isinstance(body, Record) else {}
+        if event == 'output' and 'output' in fields and 'category' in fields:
+            # the key is the stream: category, group and source. Output that
+            # carries anything else of its own (a line, variables, data) is
+            # sent as it is, merging would keep only the last one.
+            record = '{{{}}}'.format(', '.join(
+                '{0} = {1}'.format(k, 'output' if k == 'output' else '#{} body'.format(k)) for k in fields))
+            key = [k for k in ('category', 'group', 'source') if k in fields]
+            own = [k for k, v in fields.items() if k not in key and k != 'output' and isinstance(v, Option)]
+            key += [k for k in fields if k not in key and k not in own and k != 'output']
+            em.i_print('fun send{} (ch : Event.channel) (body : {}) = let'.format(name, body.s(None)))
+            em.indent += 4
+            em.i_print('fun render (seq, output) = {}.toJsonString ({})'.format(name, event_record(name, obj, 'seq', record)))
+            em.i_print('fun key () = let')
+            em.i_print('    val b = JsonBuf.new 64')
+            em.i_print('  in')
+            for i, k in enumerate(key):
+                if i > 0:
+                    em.i_print('    JsonBuf.add (b, ",");')
+                em.i_print('    {};'.format(fields[k].write_json(None, '(#{} body)'.format(k))))
+            em.i_print('    JsonBuf.contents b')
+            em.i_print('  end')
+            em.indent -= 2
+            em.i_print('in')
+            if own:
+                em.i_print('  if {} then ch (Event.Plain (fn seq => render (seq, #output body)))'.format(
+                    ' orelse '.join('isSome (#{} body)'.format(k) for k in own)))
+                em.i_print('  else ch (Event.Output {key = key (), text = #output body, render = render})')
+            else:
+                em.i_print('  ch (Event.Output {key = key (), text = #output body, render = render})')
+            em.i_print('end')
+            em.indent -= 2
+            continue
+        if event == 'progressUpdate' and 'progressId' in fields:
+            em.i_print('fun send{} (ch : Event.channel) (body : {}) ='.format(name, body.s(None)))
+        else:
+            em.i_print('fun send{} (ch : Event.channel) {} ='.format(name, arg))
+        em.indent += 2
+        if event == 'progressUpdate' and 'progressId' in fields:
+            em.i_print('ch (Event.Progress {{id = #progressId body, render = fn seq => {}.toJsonString ({})}})'.format(
+                name, event_record(name, obj, 'seq', 'body')))
+        else:
+            em.i_print('ch (Event.Plain (fn seq => {}.toJsonString ({})))'.format(name, event_record(name, obj, 'seq', arg)))
+        em.indent -= 2
+    em.indent -= 2
+    em.i_print('end\n')
+
+class Profiler(object):
+    # Wall time and traced memory of each generation phase. A disabled
+    # profiler's phases do nothing.
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = []
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            current, peak = tracemalloc.get_traced_memory()
+            self.phases.append({'phase': name, 'seconds': seconds,
+                                'peak_bytes': peak, 'retained_bytes': current - base})
+
+    def report(self, out):
+        out.write('{:<18} {:>10} {:>12} {:>12}\n'.format('phase', 'ms', 'peak KiB', 'retained KiB'))
+        for p in self.phases:
+            out.write('{:<18} {:>10.2f} {:>12.1f} {:>12.1f}\n'.format(
+                p['phase'], p['seconds'] * 1e3, p['peak_bytes'] / 1024.0, p['retained_bytes'] / 1024.0))
+
+def dependency_depth(dep_graph):
+    # Longest chain of structures that depend on each other, a cycle counts
+    # as one link.
+    depth = {}
+    for comp in fragment_cache.strongly_connected(dep_graph):
+        members = set(comp)
+        d = 1 + max([depth[dep] for n in comp for dep in dep_graph[n] if dep not in members] or [0])
+        for n in comp:
+            depth[n] = d
+    return max(depth.values() or [0])
+
+def output_stats(model, names, sizes, largest=10):
+    kinds = {}
+    records = []
+    for name in names:
+        obj = model.converted[name]
+        kind = 'Record' if hasattr(obj, 'props') else type(obj).__name__
+        kinds[kind] = kinds.get(kind, 0) + 1
+        if hasattr(obj, 'props'):
+            records.append((len(obj.props), name))
+    records.sort(key=lambda r: (-r[0], r[1]))
+    return {
+        'structures': len(names),
+        'kinds': kinds,
+        'bytes': sum(sizes.values()),
+        'structure_bytes': sizes,
+        'largest_records': [{'name': name, 'fields': n} for n, name in records[:largest]],
+        'dependency_depth': dependency_depth(model.dep_graph),
+    }
+
+class Model(object):
+    # The converted definitions together with their emission order and the
+    # request/response pairs the dispatcher is generated for.
+    def __init__(self, schema, profiler=None):
+        if profiler is None:
+            profiler = Profiler()
+
+        with profiler.phase('create_converted'):
+            self.converted = create_converted(schema['definitions'])
+
+        with profiler.phase('toposort'):
+            self.dep_graph = {}
+            for name, obj in self.converted.items():
+                self.dep_graph[name] = obj.structure_deps()
+
+            # sorted within each group so the output only changes when the schema does
+            self.dep_ord_names = toposort.toposort_flatten(self.dep_graph, sort=True)
+
+        with profiler.phase('classify'):
+            self.msgs = {'requests':{}, 'events':{}}
+
+            for name, schem in self.converted.items():
+                if hasattr(schem, 'props'):
+                    t = schem.props.get('type_', None)
+                    if is_request(schem):
+                        assert name.endswith('Request')
+                        name = name[0:-len('Request')]
+                        if name=='':
+                            continue
+                        if name in self.msgs['requests']:
+                            self.msgs['requests'][name]['req'] = schem
+                        else:
+                            self.msgs['requests'][name] = {'req':schem}
+                    if isinstance(t, Enum) and t.constant() == 'response':
+                        assert name.endswith('Response')
+                        name = name[0:-len('Response')]
+                        if name=='':
+                            continue
+                        if name in self.msgs['requests']:
+                            self.msgs['requests'][name]['resp'] = schem
+                        else:
+                            self.msgs['requests'][name] = {'resp':schem}
+                    e = schem.props.get('event', None)
+                    if isinstance(t, Enum) and t.constant() == 'event' and e is not None and e.json_constant() is not None:
+                        self.msgs['events'][json.loads(e.json_constant())] = schem
+
+    # Everything a Model holds, written to intermediate files. The nodes are
+    # pickled as one graph, so shared nodes stay shared when loaded.
+    fields = ('converted', 'dep_graph', 'dep_ord_names', 'msgs')
+    magic = b'DAPMODEL1\n'
+
+    def save(self, path):
+        state = dict((k, getattr(self, k)) for k in self.fields)
+        data = zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+        fragment_cache.write_if_changed(path, self.magic + data)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(cls.magic):
+            raise ValueError('{} is not a converted model'.format(path))
+        model = cls.__new__(cls)
+        model.__dict__.update(pickle.loads(zlib.decompress(data[len(cls.magic):])))
+        return model
+
+    def commands(self):
+        # ErrorResponse has no matching request, it is not a command
+        return dict((name, m) for name, m in self.msgs['requests'].items() if 'req' in m and 'resp' in m)
+
+    def reachable(self, roots):
+        seen = set()
+        stack = list(roots)
+        while stack:
+            name = stack.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            stack.extend(self.dep_graph[name])
+        return seen
+
+    def prune(self, commands, events):
+        # Only the given commands get handlers, and only the structures their
+        # requests, responses and the given events refer to are emitted.
+        all_commands = self.commands()
+        requests = {}
+        roots = []
+        for command in commands:
+            name = upper_first(command)
+            if name not in all_commands:
+                raise UnknownRootException('command', command)
+            requests[name] = all_commands[name]
+            roots += [name+'Request', name+'Response']
+        for event in events:
+            name = upper_first(event)+'Event'
+            if name not in self.converted:
+                raise UnknownRootException('event', event)
+            roots.append(name)
+        keep = self.reachable(roots)
+        return requests, [n for n in self.dep_ord_names if n in keep]
+
+class UnknownRootException(Exception):
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+
+    def __str__(self):
+        return 'No {} named {} in the schema'.format(self.kind, self.name)
+
+class Options(object):
+    def __init__(self, ignored=ignored_schems, buffer_size=1<<16, encoding='utf-8', cache_dir=None,
+                 commands=None, events=None, lazy_arguments=False, profiler=None, stats=False):
+        self.ignored = ignored
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.cache_dir = cache_dir
+        # when either is given only what they reach is generated
+        self.commands = commands
+        self.events = events
+        # handlers receive XxxRequest.lazy and decode arguments with force
+        self.lazy_arguments = lazy_arguments
+        self.profiler = profiler if profiler is not None else Profiler()
+        # collect output statistics into model.stats
+        self.stats = stats
+
+def print_structure(em, name, schem):
+    if name in runtime_structures:
+        raise ReservedNameException(name)
     if isinstance(schem, Enum):
-        print_enum(schem)
+        print_enum(em, schem)
     elif hasattr(schem, 'props'):
-        print_obj(schem)
+        print_obj(em, schem)
     elif isinstance(schem, JsonObject):
-        i_print('structure {} = struct type t = Json.value fun toJson x = x fun fromJson x = x end'.format(name))
+        em.i_print('structure {} = struct type t = Json.value fun toJson x = x fun writeJson b x = JsonBuf.addValue b x fun toJsonString x = JsonBuf.toString writeJson x fun readJson p = JsonPull.readValue p fun fromJsonString s = JsonPull.decodeString readJson s fun fromJson x = x end'.format(name))
     else:
         assert False
 
-print_handle_sig(msgs['requests'])
-print_handler(msgs['requests'])
\ No newline at end of file
+def render_structure(name, schem):
+    out = io.StringIO()
+    em = Emitter(out)
+    print_structure(em, name, schem)
+    em.flush()
+    return out.getvalue()
+
+def select(model, options):
+    # the requests to handle and the structures to emit, in emission order
+    if options.commands is None and options.events is None:
+        requests, names = model.commands(), model.dep_ord_names
+    else:
+        requests, names = model.prune(options.commands or [], options.events or [])
+    return requests, [n for n in names if n not in options.ignored]
+
+def print_dispatch(em, model, requests, emitted, options):
+    emitted_set = set(emitted)
+    print_events(em, dict((e, obj) for e, obj in model.msgs['events'].items() if obj.name in emitted_set))
+    print_handle_sig(em, requests, options.lazy_arguments)
+    print_handler(em, requests, options.lazy_arguments)
+
+def generator_salt():
+    # Fragments have to be re-rendered whenever the generator itself changes.
+    return fragment_cache.file_digest(__file__)
+
+def generate(schema, out_stream, options=None):
+    if options is None:
+        options = Options()
+
+    profiler = options.profiler
+    cache = None
+    if options.cache_dir is not None:
+        with profiler.phase('fragment_keys'):
+            keys = fragment_cache.fragment_keys(schema['definitions'], generator_salt())
+            cache = fragment_cache.FragmentCache(options.cache_dir)
+
+    model = Model(schema, profiler)
+    if cache is not None:
+        # whether a shape is shared, and under which name, depends on the
+        # other definitions too
+        shared = set(model.converted).difference(keys)
+        keys = dict((name, fragment_cache.extend_key(key, model.dep_graph[name] & shared)) for name, key in keys.items())
+    requests, emitted = select(model, options)
+    sizes = {}
+
+    with profiler.phase('emit'):
+        em = Emitter(out_stream, options.buffer_size, options.encoding)
+
+        em.i_print(header)
+        for name in emitted:
+            schem = model.converted[name]
+            if cache is None and not options.stats:
+                print_structure(em, name, schem)
+                continue
+            if cache is None or name not in keys:
+                text = render_structure(name, schem)
+            else:
+                text = cache.get(keys[name], lambda: render_structure(name, schem))
+            if options.stats:
+                sizes[name] = len(text.encode(options.encoding))
+            em.write(text)
+
+        print_dispatch(em, model, requests, emitted, options)
+        em.flush()
+
+    if cache is not None:
+        cache.save()
+    model.cache = cache
+    model.stats = output_stats(model, emitted, sizes) if options.stats else None
+    return model
+
+# Batch generation: every schema is converted once, in a worker of its own,
+# and the model is written to an intermediate file. Each output is then
+# emitted in shards, contiguous runs of its structures rendered by separate
+# workers from that file, and put together in order by the parent. The
+# output is the same as generate's.
+
+def model_key(data):
+    return hashlib.sha256(generator_salt().encode('utf-8') + data).hexdigest()
+
+def convert_schema(schema_path, model_dir):
+    # models are named by the schema's content, a schema seen before is
+    # not converted again
+    with open(schema_path, 'rb') as f:
+        data = f.read()
+    path = os.path.join(model_dir, model_key(data) + '.dapmodel')
+    if os.path.exists(path):
+        return path, False
+    Model(json.loads(data.decode('utf-8'))).save(path)
+    return path, True
+
+# models loaded by this worker, by path
+loaded_models = {}
+
+def shard_names(model, names, shard, shards):
+    # shards cover about the same number of fields, each name goes to the
+    # shard its offset falls in
+    weights = [len(getattr(model.converted[n], 'props', ())) + 1 for n in names]
+    total = sum(weights)
+    lo, hi = total * shard // shards, total * (shard + 1) // shards
+    out = []
+    offset = 0
+    for name, w in zip(names, weights):
+        if lo <= offset < hi:
+            out.append(name)
+        offset += w
+    return out
+
+def emit_shard(model_path, job, shard, shards):
+    if model_path not in loaded_models:
+        loaded_models[model_path] = Model.load(model_path)
+    model = loaded_models[model_path]
+    options = Options(commands=job.get('commands'), events=job.get('events'),
+                      lazy_arguments=job.get('lazy_arguments', False))
+    requests, emitted = select(model, options)
+
+    out = io.BytesIO()
+    em = Emitter(out, options.buffer_size, options.encoding)
+    if shard == 0:
+        em.i_print(header)
+    for name in shard_names(model, emitted, shard, shards):
+        print_structure(em, name, model.converted[name])
+    if shard == shards - 1:
+        print_dispatch(em, model, requests, emitted, options)
+    em.flush()
+    return out.getvalue()
+
+def read_manifest(path):
+    # a list of {"schema", "output"} objects, optionally with "commands",
+    # "events" and "lazy_arguments" as on the command line. Paths are
+    # relative to the manifest.
+    with open(path) as f:
+        jobs = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    for job in jobs:
+        job['schema'] = os.path.join(base, job['schema'])
+        job['output'] = os.path.join(base, job['output'])
+    return jobs
+
+def run_batch(jobs, model_dir, workers=None, shards=None):
+    workers = workers or os.cpu_count() or 1
+    if shards is None:
+        shards = max(1, workers // len(jobs))
+    schemas = sorted(set(job['schema'] for job in jobs))
+    parts = [[None] * shards for _job in jobs]
+    models = {}
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        converting = dict((pool.submit(convert_schema, schema, model_dir), schema) for schema in schemas)
+        emitting = {}
+        # a schema's outputs are emitted as soon as it is converted
+        for fut in concurrent.futures.as_completed(converting):
+            schema = converting[fut]
+            models[schema] = fut.result()
+            for i, job in enumerate(jobs):
+                if job['schema'] == schema:
+                    for k in range(shards):
+                        emitting[pool.submit(emit_shard, models[schema][0], job, k, shards)] = (i, k)
+        for fut in concurrent.futures.as_completed(emitting):
+            i, k = emitting[fut]
+            parts[i][k] = fut.result()
+
+    # only the models used by this run are kept
+    used = set(os.path.basename(path) for path, _converted in models.values())
+    for f in os.listdir(model_dir):
+        if f.endswith('.dapmodel') and f not in used:
+            os.remove(os.path.join(model_dir, f))
+
+    return [{'schema': job['schema'], 'output': job['output'], 'converted': models[job['schema']][1],
+             'changed': fragment_cache.write_if_changed(job['output'], b''.join(parts[i]))}
+            for i, job in enumerate(jobs)]
+
+def main_batch(args):
+    jobs = read_manifest(args.batch)
+    if not jobs:
+        return
+    start = time.perf_counter()
+    if args.model_dir is None:
+        with tempfile.TemporaryDirectory() as model_dir:
+            results = run_batch(jobs, model_dir, args.jobs, args.shards)
+    else:
+        os.makedirs(args.model_dir, exist_ok=True)
+        results = run_batch(jobs, args.model_dir, args.jobs, args.shards)
+    if args.profile:
+        for r in results:
+            sys.stderr.write('{} -> {}: {}, {}\n'.format(
+                r['schema'], r['output'], 'converted' if r['converted'] else 'model reused',
+                'written' if r['changed'] else 'unchanged'))
+        sys.stderr.write('batch of {} outputs in {:.2f} ms\n'.format(len(results), (time.perf_counter() - start) * 1e3))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Generate SML bindings for the Debug Adapter Protocol')
+    parser.add_argument('schema', nargs='?', default='debugProtocol.json')
+    parser.add_argument('-o', '--output', help='write here instead of stdout, the file is left untouched when unchanged')
+    parser.add_argument('--cache-dir', help='directory of the per-definition fragment cache')
+    parser.add_argument('--depfile', help='write a make-style dependency file')
+    parser.add_argument('--dep-target', help='target named in the depfile (default: the output)')
+    parser.add_argument('--commands', help='comma separated commands to generate handlers for (default: all)')
+    parser.add_argument('--events', help='comma separated events to generate structures for')
+    parser.add_argument('--lazy-arguments', action='store_true', help='pass requests to handlers with their arguments undecoded')
+    parser.add_argument('--profile', action='store_true', help='report wall time and peak memory per phase on stderr')
+    parser.add_argument('--stats', help='write a JSON report of the output (and phases with --profile) here')
+    parser.add_argument('--batch', help='generate the outputs listed in this JSON manifest in parallel, see read_manifest')
+    parser.add_argument('-j', '--jobs', type=int, help='worker processes for --batch (default: one per core)')
+    parser.add_argument('--shards', type=int, help='workers emitting each output of --batch (default: the cores spread over the outputs)')
+    parser.add_argument('--model-dir', help='keep the converted models of --batch here between runs')
+    args = parser.parse_args(argv[1:])
+
+    if args.batch is not None:
+        if args.output or args.cache_dir or args.depfile or args.commands or args.events or args.stats:
+            parser.error('--batch takes outputs and their options from the manifest')
+        main_batch(args)
+        return
+
+    def names(arg):
+        return None if arg is None else [n for n in arg.split(',') if n]
+
+    profiler = Profiler(args.profile)
+    with profiler.phase('json.load'):
+        with open(args.schema) as f:
+            schema = json.load(f)
+    options = Options(cache_dir=args.cache_dir, commands=names(args.commands), events=names(args.events),
+                      lazy_arguments=args.lazy_arguments, profiler=profiler, stats=args.stats is not None)
+
+    if args.output is None:
+        model = generate(schema, sys.stdout, options)
+    else:
+        out = io.BytesIO()
+        model = generate(schema, out, options)
+        fragment_cache.write_if_changed(args.output, out.getvalue())
+
+    if args.profile:
+        profiler.report(sys.stderr)
+    if args.stats is not None:
+        report = dict(model.stats)
+        if args.profile:
+            report['phases'] = profiler.phases
+        with open(args.stats, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.depfile is not None:
+        target = args.dep_target or args.output or '-'
+        fragment_cache.write_depfile(args.depfile, target, [args.schema, __file__, fragment_cache.__file__])
+
+if __name__ == '__main__':
+    # run as the imported module, so pickled models name their classes after
+    # a module the batch workers can import
+    import jsonschema_test
+    jsonschema_test.main(sys.argv)
@@ -0,0 +1,256 @@
+import argparse
+import asyncio
+import json
+import math
+import resource
+import sys
+import time
+
+import jsonschema_test as gen
+
+# Load generator for the adapter binary. Drives scripted debug sessions over
+# framed stdin/stdout, either one adapter process per session or all sessions
+# interleaved on one process, and reports latency per command, throughput and
+# peak RSS. A shared process is one debug session: it is initialized and
+# launched once, the sessions only interleave their request rounds on it, and
+# it is disconnected once at the end. Requests are built from the same model
+# the SML bindings are generated from: every required argument field gets a
+# placeholder of its schema type, which the session script then overrides
+# where it matters.
+
+def sample(model, t, depth=0):
+    if isinstance(t, gen.RefObj):
+        return sample(model, model.converted[t.parse_name()], depth + 1)
+    elif isinstance(t, gen.Record):
+        if depth > 16:
+            return {}
+        # optional fields are left out, the script sets the ones it needs
+        return dict((gen.field_name_to_prop.get(k, k), sample(model, v, depth + 1))
+                    for k, v in t.props.items() if not isinstance(v, gen.Option))
+    elif isinstance(t, gen.Enum):
+        const = t.json_constant()
+        return json.loads(const) if const is not None else sorted(t.values)[0]
+    elif isinstance(t, (gen.Integer, gen.IntOrString)):
+        return 0
+    elif isinstance(t, gen.Real):
+        return 0.0
+    elif isinstance(t, gen.Boolean):
+        return False
+    elif isinstance(t, (gen.String, gen.Bytes)):
+        return ''
+    elif isinstance(t, (gen.StringMap, gen.JsonObject)):
+        return {}
+    elif isinstance(t, gen.Array):
+        return []
+    else:
+        return None
+
+def merge(base, override):
+    for k, v in override.items():
+        if isinstance(v, dict) and isinstance(base.get(k), dict):
+            merge(base[k], v)
+        else:
+            base[k] = v
+    return base
+
+class MessageBuilder(object):
+    def __init__(self, model):
+        self.model = model
+        self.commands = model.commands()
+        self.templates = {}
+
+    def template(self, command):
+        if command not in self.templates:
+            name = gen.upper_first(command)
+            if name not in self.commands:
+                raise gen.UnknownRootException('command', command)
+            args = self.commands[name]['req'].props.get('arguments')
+            self.templates[command] = None if args is None else json.dumps(sample(self.model, args))
+        return self.templates[command]
+
+    def request(self, command, seq, arguments=None):
+        msg = {'seq': seq, 'type': 'request', 'command': command}
+        template = self.template(command)
+        if template is not None:
+            msg['arguments'] = merge(json.loads(template), arguments or {})
+        return msg
+
+def session_start():
+    yield 'initialize', {'clientID': 'load-test', 'adapterID': 'sml-debugger', 'linesStartAt1': True,
+                         'columnsStartAt1': True, 'pathFormat': 'path', 'supportsVariablePaging': True}
+    yield 'setBreakpoints', {'source': {'path': '/tmp/load-test.sml'}, 'breakpoints': [{'line': 10}], 'lines': [10]}
+    yield 'launch', {}
+
+def session_rounds(iterations):
+    for i in range(iterations):
+        yield 'stackTrace', {'threadId': 1, 'levels': 20}
+        yield 'scopes', {'frameId': 1}
+        yield 'variables', {'variablesReference': 1, 'count': 100}
+        yield 'evaluate', {'expression': 'x + {}'.format(i), 'frameId': 1}
+
+def session_end():
+    yield 'disconnect', {}
+
+def session_script(iterations):
+    yield from session_start()
+    yield from session_rounds(iterations)
+    yield from session_end()
+
+def frame(msg):
+    payload = json.dumps(msg, separators=(',', ':')).encode('utf-8')
+    return b'Content-Length: ' + str(len(payload)).encode('ascii') + b'\r\n\r\n' + payload
+
+def peak_rss_kb(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+class Connection(object):
+    # One adapter process. Responses are matched to their requests through
+    # request_seq, so any number of sessions can share it.
+    def __init__(self, proc, timeout):
+        self.proc = proc
+        self.timeout = timeout
+        self.seq = 0
+        self.pending = {}
+        self.received = 0
+        self.events = 0
+        self.reader = asyncio.ensure_future(self.read_loop())
+
+    @classmethod
+    async def spawn(cls, argv, timeout):
+        proc = await asyncio.create_subprocess_exec(*argv, stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.PIPE)
+        return cls(proc, timeout)
+
+    async def read_loop(self):
+        out = self.proc.stdout
+        try:
+            while True:
+                header = await out.readuntil(b'\r\n\r\n')
+                length = None
+                for line in header.decode('ascii').split('\r\n'):
+                    name, _, value = line.partition(':')
+                    if name.strip().lower() == 'content-length':
+                        length = int(value)
+                msg = json.loads(await out.readexactly(length))
+                self.received += 1
+                if msg.get('type') == 'response':
+                    fut = self.pending.pop(msg.get('request_seq'), None)
+                    if fut is not None and not fut.done():
+                        fut.set_result(msg)
+                else:
+                    self.events += 1
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for fut in self.pending.values():
+                if not fut.done():
+                    fut.set_exception(EOFError('adapter closed its output'))
+
+    async def send(self, msg):
+        # the response to msg and how long it took
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[msg['seq']] = fut
+        start = time.perf_counter()
+        self.proc.stdin.write(frame(msg))
+        await self.proc.stdin.drain()
+        resp = await asyncio.wait_for(fut, self.timeout)
+        return resp, time.perf_counter() - start
+
+    async def call(self, builder, command, arguments):
+        self.seq += 1
+        return await self.send(builder.request(command, self.seq, arguments))
+
+    async def close(self):
+        rss = peak_rss_kb(self.proc.pid)
+        self.proc.stdin.close()
+        await self.proc.wait()
+        await self.reader
+        return rss
+
+class Stats(object):
+    def __init__(self):
+        self.latencies = {}
+        self.failures = {}
+
+    def add(self, command, resp, secs):
+        self.latencies.setdefault(command, []).append(secs)
+        if not resp.get('success', False):
+            self.failures[command] = self.failures.get(command, 0) + 1
+
+    def requests(self):
+        return sum(len(v) for v in self.latencies.values())
+
+def percentile(sorted_values, p):
+    # nearest rank
+    k = max(0, min(len(sorted_values) - 1, math.ceil(p / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+async def run_script(conn, builder, stats, script):
+    for command, arguments in script:
+        resp, secs = await conn.call(builder, command, arguments)
+        stats.add(command, resp, secs)
+
+async def run(args, builder):
+    stats = Stats()
+    start = time.perf_counter()
+    if args.shared:
+        conns = [await Connection.spawn(args.adapter, args.timeout)]
+        await run_script(conns[0], builder, stats, session_start())
+        await asyncio.gather(*[run_script(conns[0], builder, stats, session_rounds(args.iterations))
+                               for _i in range(args.sessions)])
+        await run_script(conns[0], builder, stats, session_end())
+    else:
+        conns = [await Connection.spawn(args.adapter, args.timeout) for _i in range(args.sessions)]
+        await asyncio.gather(*[run_script(c, builder, stats, session_script(args.iterations)) for c in conns])
+    elapsed = time.perf_counter() - start
+    rss = [await c.close() for c in conns]
+    received = sum(c.received for c in conns)
+    events = sum(c.events for c in conns)
+    peak = max(rss) or resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return stats, elapsed, received, events, peak
+
+def report(stats, elapsed, received, events, peak):
+    print('{:<16} {:>8} {:>8} {:>10} {:>10}'.format('command', 'count', 'failed', 'p50 ms', 'p99 ms'))
+    for command in sorted(stats.latencies):
+        values = sorted(stats.latencies[command])
+        print('{:<16} {:>8} {:>8} {:>10.3f} {:>10.3f}'.format(
+            command, len(values), stats.failures.get(command, 0),
+            percentile(values, 50) * 1e3, percentile(values, 99) * 1e3))
+    n = stats.requests()
+    print('requests {} in {:.3f}s, {:.0f} requests/s, {:.0f} msgs/s ({} events)'.format(
+        n, elapsed, n / elapsed, (n + received) / elapsed, events))
+    print('peak RSS {:.1f} MB'.format(peak / 1024.0))
+
+def split_command(argv):
+    # the options, and the adapter command line after --
+    if '--' in argv:
+        i = argv.index('--')
+        return argv[:i], argv[i + 1:]
+    return argv, []
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Drive scripted debug sessions against the adapter',
+                                     usage='%(prog)s [options] [-- adapter [args ...]]',
+                                     epilog='The adapter command line comes last, after --, ./sml-debug-adapter when it is not given')
+    parser.add_argument('--schema', default='debugProtocol.json')
+    parser.add_argument('-n', '--sessions', type=int, default=8)
+    parser.add_argument('--iterations', type=int, default=100, help='stackTrace/scopes/variables/evaluate rounds per session')
+    parser.add_argument('--shared', action='store_true', help='interleave the request rounds of all sessions on one adapter process, initialized once')
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for each response')
+    options, command = split_command(argv[1:])
+    args = parser.parse_args(options)
+    args.adapter = command or ['./sml-debug-adapter']
+
+    with open(args.schema) as f:
+        builder = MessageBuilder(gen.Model(json.load(f)))
+    report(*asyncio.run(run(args, builder)))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,272 @@
+import argparse
+import io
+import json
+import keyword
+import sys
+
+import fragment_cache
+import jsonschema_test as gen
+
+# Python backend. Emits a module with a __slots__ class per record of the
+# converted model, each with from_dict and to_dict written out field by field
+# for its shape, so decoding a message is a fixed sequence of lookups and
+# constructor calls, with nothing inspected at runtime. Values the SML side
+# keeps as strings, numbers or Json.value stay the plain values json.loads
+# gives, base64 fields are decoded to bytes. Nothing is validated, that is
+# up to the caller.
+
+prelude = '''\
+# Generated by python_codec.py, do not edit.
+from base64 import b64decode, b64encode
+
+
+class Struct(object):
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(other) is type(self) and all(getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join('{}={!r}'.format(k, getattr(self, k)) for k in self.__slots__))
+'''
+
+def attr_name(field):
+    return field + '_' if keyword.iskeyword(field) else field
+
+def tuple_literal(items):
+    items = [repr(i) for i in items]
+    return '({},)'.format(items[0]) if len(items) == 1 else '({})'.format(', '.join(items))
+
+def json_name(field):
+    return gen.field_name_to_prop.get(field, field)
+
+class Backend(object):
+    def __init__(self, model):
+        self.model = model
+        # class names of the records, by node id. Inline records that are not
+        # shared are named after their definition and property path.
+        self.classes = {}
+        taken = set(model.converted) | {'Struct'}
+        for name, obj in model.converted.items():
+            if isinstance(obj, gen.Record):
+                self.classes[id(obj)] = name
+        for name, obj in model.converted.items():
+            if isinstance(obj, gen.Record):
+                for node, path in gen.inline_nodes(obj):
+                    if isinstance(node, gen.Record) and node.shared is None and id(node) not in self.classes:
+                        self.classes[id(node)] = gen.pick_name([name + ''.join(gen.path_names(path))], taken)
+
+    def record(self, t):
+        # the record a value of type t is decoded to, if any
+        if isinstance(t, gen.RefObj):
+            t = self.model.converted[t.parse_name()]
+        return t if isinstance(t, gen.Record) else None
+
+    def is_plain(self, t):
+        # values json.loads already gives as they are
+        if isinstance(t, (gen.Array, gen.StringMap)):
+            return self.is_plain(t.e)
+        if isinstance(t, gen.Option):
+            return self.is_plain(t.o)
+        return self.record(t) is None and not isinstance(t, gen.Bytes)
+
+    def decode(self, t, v, depth=0):
+        rec = self.record(t)
+        if rec is not None:
+            return '{}.from_dict({})'.format(self.classes[id(rec)], v)
+        elif isinstance(t, gen.Bytes):
+            return 'b64decode({})'.format(v)
+        elif isinstance(t, gen.Array) and not self.is_plain(t):
+            x = 'x{}'.format(depth)
+            return '[{} for {} in {}]'.format(self.decode(t.e, x, depth + 1), x, v)
+        elif isinstance(t, gen.StringMap) and not self.is_plain(t):
+            x = 'x{}'.format(depth)
+            return '{{k{}: {} for k{}, {} in {}.items()}}'.format(depth, self.decode(t.e, x, depth + 1), depth, x, v)
+        return v
+
+    def encode(self, t, v, depth=0):
+        if self.record(t) is not None:
+            return '{}.to_dict()'.format(v)
+        elif isinstance(t, gen.Bytes):
+            return "b64encode({}).decode('ascii')".format(v)
+        elif isinstance(t, gen.Array) and not self.is_plain(t):
+            x = 'x{}'.format(depth)
+            return '[{} for {} in {}]'.format(self.encode(t.e, x, depth + 1), x, v)
+        elif isinstance(t, gen.StringMap) and not self.is_plain(t):
+            x = 'x{}'.format(depth)
+            return '{{k{}: {} for k{}, {} in {}.items()}}'.format(depth, self.encode(t.e, x, depth + 1), depth, x, v)
+        return v
+
+    def print_record(self, em, obj):
+        cls = self.classes[id(obj)]
+        # failed responses often come without the body the schema requires,
+        # a response body is decoded as None when it is missing
+        response = obj.props.get('type_') is not None and obj.props['type_'].json_constant() == '"response"'
+        fields = [(k, gen.Option(v) if response and k == 'body' and not isinstance(v, gen.Option) else v)
+                  for k, v in obj.props.items()]
+        # required fields come first in the constructor, constants default to
+        # their value and optional fields to None
+        def order(item):
+            k, v = item
+            return 2 if isinstance(v, gen.Option) else 1 if v.json_constant() is not None else 0
+        params = sorted(fields, key=order)
+
+        em.i_print('')
+        em.i_print('')
+        em.i_print('class {}(Struct):'.format(cls))
+        em.indent += 4
+        for line in obj.descr.splitlines():
+            em.i_print(('# ' + line).rstrip())
+        em.i_print('__slots__ = {}'.format(tuple_literal([attr_name(k) for k, _v in params])))
+
+        args = []
+        for k, v in params:
+            if isinstance(v, gen.Option):
+                args.append('{}=None'.format(attr_name(k)))
+            elif v.json_constant() is not None:
+                args.append('{}={!r}'.format(attr_name(k), json.loads(v.json_constant())))
+            else:
+                args.append(attr_name(k))
+        em.write('\n')
+        em.i_print('def __init__({}):'.format(', '.join(['self'] + args)))
+        em.indent += 4
+        for k, _v in params:
+            em.i_print('self.{0} = {0}'.format(attr_name(k)))
+        if not params:
+            em.i_print('pass')
+        em.indent -= 4
+
+        em.write('\n')
+        em.i_print('@staticmethod')
+        em.i_print('def from_dict(d):')
+        em.indent += 4
+        values = []
+        for k, v in params:
+            key = repr(json_name(k))
+            if not isinstance(v, gen.Option):
+                values.append(self.decode(v, 'd[{}]'.format(key)))
+            elif self.is_plain(v):
+                values.append('d.get({})'.format(key))
+            else:
+                local = 'v_' + attr_name(k)
+                em.i_print('{} = d.get({})'.format(local, key))
+                values.append('None if {0} is None else {1}'.format(local, self.decode(v.o, local)))
+        em.i_print('return {}({})'.format(cls, ', '.join(values)))
+        em.indent -= 4
+
+        em.write('\n')
+        em.i_print('def to_dict(self):')
+        em.indent += 4
+        required = []
+        for k, v in fields:
+            if isinstance(v, gen.Option):
+                continue
+            const = v.json_constant()
+            value = repr(json.loads(const)) if const is not None else self.encode(v, 'self.' + attr_name(k))
+            required.append('{!r}: {}'.format(json_name(k), value))
+        em.i_print('d = {{{}}}'.format(', '.join(required)))
+        for k, v in fields:
+            if isinstance(v, gen.Option):
+                em.i_print('if self.{} is not None:'.format(attr_name(k)))
+                em.i_print('    d[{!r}] = {}'.format(json_name(k), self.encode(v.o, 'self.' + attr_name(k))))
+        em.i_print('return d')
+        em.indent -= 8
+
+    def print_enum(self, em, obj):
+        # the values as class attributes, the values themselves are strings
+        em.i_print('')
+        em.i_print('')
+        em.i_print('class {}(object):'.format(obj.shared or obj.name))
+        em.indent += 4
+        for line in obj.descr.splitlines():
+            em.i_print(('# ' + line).rstrip())
+        for value in obj.values:
+            em.i_print('{} = {!r}'.format(attr_name(gen.enum_constructor(value)), value))
+        em.i_print('values = frozenset({})'.format(tuple_literal(obj.values)))
+        em.indent -= 4
+
+    def print_dispatch(self, em, requests, emitted):
+        # message classes by command and event, from_message picks one
+        emitted = set(emitted)
+        def table(name, items):
+            em.i_print('')
+            em.i_print('{} = {{'.format(name))
+            for key, obj in sorted(items):
+                if obj.name in emitted:
+                    em.i_print('    {!r}: {},'.format(key, self.classes[id(obj)]))
+            em.i_print('}')
+
+        commands = [(json.loads(m['req'].props['command'].json_constant()), m) for m in requests.values()]
+        em.i_print('')
+        table('requests', [(c, m['req']) for c, m in commands])
+        table('responses', [(c, m['resp']) for c, m in commands])
+        table('events', list(self.model.msgs['events'].items()))
+        error = self.model.converted.get('ErrorResponse')
+        em.i_print('')
+        em.i_print('')
+        em.i_print('def from_message(d):')
+        em.i_print('    # decodes a message of a known command or event, anything else is returned as it is')
+        em.i_print("    t = d.get('type')")
+        em.i_print("    if t == 'request':")
+        em.i_print("        cls = requests.get(d.get('command'))")
+        em.i_print("    elif t == 'response':")
+        if error is not None and 'ErrorResponse' in emitted:
+            em.i_print("        cls = responses.get(d.get('command')) if d.get('success') else ErrorResponse")
+        else:
+            em.i_print("        cls = responses.get(d.get('command'))")
+        em.i_print("    elif t == 'event':")
+        em.i_print("        cls = events.get(d.get('event'))")
+        em.i_print('    else:')
+        em.i_print('        cls = None')
+        em.i_print('    return d if cls is None else cls.from_dict(d)')
+
+def generate(schema, out_stream, options=None):
+    if options is None:
+        options = gen.Options()
+    model = gen.Model(schema, options.profiler)
+    requests, emitted = gen.select(model, options)
+    backend = Backend(model)
+
+    with options.profiler.phase('emit'):
+        em = gen.Emitter(out_stream, options.buffer_size, options.encoding)
+        em.write(prelude)
+        printed = set()
+        for name in emitted:
+            obj = model.converted[name]
+            if isinstance(obj, gen.Enum):
+                backend.print_enum(em, obj)
+            elif isinstance(obj, gen.Record):
+                # inline records first, a class body only refers to other
+                # classes when it runs, but reading top down is easier
+                for node, _path in gen.inline_nodes(obj):
+                    if isinstance(node, gen.Record) and node.shared is None and id(node) not in printed:
+                        printed.add(id(node))
+                        backend.print_record(em, node)
+                backend.print_record(em, obj)
+        backend.print_dispatch(em, requests, emitted)
+        em.flush()
+    return model
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Generate a Python codec module for the Debug Adapter Protocol')
+    parser.add_argument('schema', nargs='?', default='debugProtocol.json')
+    parser.add_argument('-o', '--output', help='write here instead of stdout, the file is left untouched when unchanged')
+    parser.add_argument('--commands', help='comma separated commands to generate classes for (default: all)')
+    parser.add_argument('--events', help='comma separated events to generate classes for')
+    args = parser.parse_args(argv[1:])
+
+    def names(arg):
+        return None if arg is None else [n for n in arg.split(',') if n]
+
+    with open(args.schema) as f:
+        schema = json.load(f)
+    options = gen.Options(commands=names(args.commands), events=names(args.events))
+    if args.output is None:
+        generate(schema, sys.stdout, options)
+    else:
+        out = io.BytesIO()
+        generate(schema, out, options)
+        fragment_cache.write_if_changed(args.output, out.getvalue())
+
+if __name__ == '__main__':
+    main(sys.argv)
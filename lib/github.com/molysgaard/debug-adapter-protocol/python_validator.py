@@ -0,0 +1,266 @@
+import argparse
+import io
+import json
+import sys
+
+import fragment_cache
+import jsonschema_test as gen
+import python_codec
+
+# Compiles the schema into a Python module of validation functions, one per
+# record of the converted model, so allOf is already merged and required
+# fields and enum values are what the SML bindings use. Each function looks
+# up every field once, reports the required ones that are missing and checks
+# the others with the check for their type written out in place. validate
+# stops at the first problem and raises ValidationError, validate_all returns
+# all of them. A valid message never builds a path or an error, paths are
+# linked tuples that are only turned into text when something is reported.
+
+prelude = '''\
+# Generated by python_validator.py, do not edit.
+
+
+class ValidationError(Exception):
+    def __init__(self, path, message):
+        self.path = path
+        self.message = message
+
+    def __str__(self):
+        return '{}: {}'.format(self.path, self.message)
+
+
+# marks a property that is not there, None is a value
+absent = object()
+
+
+def path_text(path):
+    keys = []
+    while path:
+        path, key = path
+        keys.append(str(key))
+    return '/' + '/'.join(reversed(keys))
+
+
+def report(errors, path, message):
+    # fail-fast when errors is None
+    e = ValidationError(path_text(path), message)
+    if errors is None:
+        raise e
+    errors.append(e)
+'''
+
+class Compiler(object):
+    def __init__(self, model):
+        self.model = model
+        self.backend = python_codec.Backend(model)
+        # names of the value sets of closed enums, by node id
+        self.enum_sets = {}
+        self.taken = set()
+
+    def function(self, rec):
+        return 'check_' + self.backend.classes[id(rec)]
+
+    def target(self, t):
+        if isinstance(t, gen.RefObj):
+            return self.model.converted[t.parse_name()]
+        return t
+
+    def trivial(self, t):
+        # every JSON value passes
+        t = self.target(t)
+        if isinstance(t, gen.Option):
+            return self.trivial(t.o)
+        return isinstance(t, gen.JsonObject)
+
+    def enum_set(self, em, enum, name):
+        if id(enum) not in self.enum_sets:
+            self.enum_sets[id(enum)] = gen.pick_name(['values_' + name], self.taken)
+            em.i_print('{} = frozenset({})'.format(self.enum_sets[id(enum)], python_codec.tuple_literal(enum.values)))
+        return self.enum_sets[id(enum)]
+
+    def print_enum_sets(self, em, t, name):
+        # module level value sets of the closed enums checked in t
+        t = self.target(t)
+        if isinstance(t, gen.Option):
+            self.print_enum_sets(em, t.o, name)
+        elif isinstance(t, (gen.Array, gen.StringMap)):
+            self.print_enum_sets(em, t.e, name)
+        elif isinstance(t, gen.Enum) and not t.open and t.constant() is None:
+            self.enum_set(em, t, t.shared or (t.name if t.owner is None else name))
+
+    def check(self, em, t, v, path, depth=0):
+        # statements checking the value of local v, found at path
+        t = self.target(t)
+        if isinstance(t, gen.Option):
+            t = self.target(t.o)
+        if self.trivial(t):
+            return
+        if isinstance(t, gen.Record):
+            em.i_print('{}({}, errors, {})'.format(self.function(t), v, path))
+        elif isinstance(t, gen.Enum) and t.constant() is not None:
+            em.i_print('if {} != {!r}:'.format(v, t.constant()))
+            em.i_print('    report(errors, {}, {!r})'.format(path, 'expected {!r}'.format(t.constant())))
+        elif isinstance(t, gen.Enum) and t.open:
+            # _enum values are only suggestions
+            em.i_print('if type({}) is not str:'.format(v))
+            em.i_print("    report(errors, {}, 'expected a string')".format(path))
+        elif isinstance(t, gen.Enum):
+            em.i_print('if type({0}) is not str or {0} not in {1}:'.format(v, self.enum_sets[id(t)]))
+            em.i_print('    report(errors, {}, {!r})'.format(path, 'expected one of ' + ', '.join(t.values)))
+        elif isinstance(t, (gen.Array, gen.StringMap)):
+            container, kind = (list, 'an array') if isinstance(t, gen.Array) else (dict, 'an object')
+            em.i_print('if type({}) is not {}:'.format(v, container.__name__))
+            em.i_print('    report(errors, {}, {!r})'.format(path, 'expected ' + kind))
+            if not self.trivial(t.e):
+                i, e = 'i{}'.format(depth), 'e{}'.format(depth)
+                em.i_print('else:')
+                em.indent += 4
+                if container is list:
+                    em.i_print('for {}, {} in enumerate({}):'.format(i, e, v))
+                else:
+                    em.i_print('for {}, {} in {}.items():'.format(i, e, v))
+                em.indent += 4
+                self.check(em, t.e, e, '({}, {})'.format(path, i), depth + 1)
+                em.indent -= 8
+        else:
+            test, kind = self.primitive(t, v)
+            em.i_print('if {}:'.format(test))
+            em.i_print('    report(errors, {}, {!r})'.format(path, 'expected ' + kind))
+
+    def primitive(self, t, v):
+        if isinstance(t, gen.Integer):
+            return 'type({}) is not int'.format(v), 'an integer'
+        elif isinstance(t, gen.Real):
+            return 'type({0}) is not float and type({0}) is not int'.format(v), 'a number'
+        elif isinstance(t, gen.Boolean):
+            return 'type({}) is not bool'.format(v), 'a boolean'
+        elif isinstance(t, (gen.String, gen.Bytes)):
+            return 'type({}) is not str'.format(v), 'a string'
+        elif isinstance(t, gen.NullableString):
+            return '{0} is not None and type({0}) is not str'.format(v), 'a string or null'
+        elif isinstance(t, gen.IntOrString):
+            return 'type({0}) is not int and type({0}) is not str'.format(v), 'an integer or a string'
+        assert False, 'no check for {}'.format(type(t).__name__)
+
+    def print_record(self, em, obj):
+        name = self.backend.classes[id(obj)]
+        consts = io.StringIO()
+        ce = gen.Emitter(consts)
+        for k, v in obj.props.items():
+            self.print_enum_sets(ce, v, name + gen.upper_first(python_codec.attr_name(k)))
+        ce.flush()
+        if consts.getvalue():
+            em.write('\n\n' + consts.getvalue())
+        em.write('\n\n')
+        em.i_print('def {}(x, errors, path):'.format(self.function(obj)))
+        em.indent += 4
+        em.i_print('if type(x) is not dict:')
+        em.i_print("    return report(errors, path, 'expected an object')")
+        for k, v in obj.props.items():
+            key = python_codec.json_name(k)
+            required = not isinstance(v, gen.Option)
+            if self.trivial(v):
+                if required:
+                    em.i_print('if {!r} not in x:'.format(key))
+                    em.i_print("    report(errors, (path, {!r}), 'missing required property')".format(key))
+                continue
+            if required:
+                em.i_print('v = x.get({!r}, absent)'.format(key))
+                em.i_print('if v is absent:')
+                em.i_print("    report(errors, (path, {!r}), 'missing required property')".format(key))
+                em.i_print('else:')
+            else:
+                # most optional fields are left out, testing for the key is
+                # cheaper than a get that misses
+                em.i_print('if {!r} in x:'.format(key))
+                em.i_print('    v = x[{!r}]'.format(key))
+            em.indent += 4
+            self.check(em, v, 'v', '(path, {!r})'.format(key))
+            em.indent -= 4
+        em.indent -= 4
+
+    def print_dispatch(self, em, requests):
+        converted = self.model.converted
+        def table(name, items):
+            em.i_print('')
+            em.i_print('{} = {{'.format(name))
+            for key, obj in sorted(items):
+                em.i_print('    {!r}: {},'.format(key, self.function(obj)))
+            em.i_print('}')
+
+        commands = [(json.loads(m['req'].props['command'].json_constant()), m) for m in requests.values()]
+        em.i_print('')
+        table('requests', [(c, m['req']) for c, m in commands])
+        table('responses', [(c, m['resp']) for c, m in commands])
+        table('events', list(self.model.msgs['events'].items()))
+        em.i_print('''
+
+def check_message(x, errors):
+    # messages of unknown commands and events are checked against their base
+    t = x.get('type') if type(x) is dict else None
+    if t == 'request':
+        check = requests.get(x.get('command'), {request})
+    elif t == 'response':
+        check = responses.get(x.get('command'), {response}) if x.get('success') is not False else {error}
+    elif t == 'event':
+        check = events.get(x.get('event'), {event})
+    else:
+        check = {base}
+    check(x, errors, ())
+
+
+def validate(x):
+    # raises ValidationError for the first problem found
+    check_message(x, None)
+
+
+def validate_all(x):
+    errors = []
+    check_message(x, errors)
+    return errors'''.format(
+            request=self.function(converted['Request']), response=self.function(converted['Response']),
+            error=self.function(converted['ErrorResponse']), event=self.function(converted['Event']),
+            base=self.function(converted['ProtocolMessage'])))
+
+def generate(schema, out_stream, options=None):
+    if options is None:
+        options = gen.Options()
+    model = gen.Model(schema, options.profiler)
+    compiler = Compiler(model)
+
+    with options.profiler.phase('emit'):
+        em = gen.Emitter(out_stream, options.buffer_size, options.encoding)
+        em.write(prelude)
+        printed = set()
+        # every record, the ones the SML bindings leave out too, they are
+        # what messages of unknown commands are checked against
+        for name in model.dep_ord_names:
+            obj = model.converted[name]
+            if not isinstance(obj, gen.Record):
+                continue
+            for node, _path in gen.inline_nodes(obj):
+                if isinstance(node, gen.Record) and node.shared is None and id(node) not in printed:
+                    printed.add(id(node))
+                    compiler.print_record(em, node)
+            compiler.print_record(em, obj)
+        compiler.print_dispatch(em, model.commands())
+        em.flush()
+    return model
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Generate a Python validator for Debug Adapter Protocol messages')
+    parser.add_argument('schema', nargs='?', default='debugProtocol.json')
+    parser.add_argument('-o', '--output', help='write here instead of stdout, the file is left untouched when unchanged')
+    args = parser.parse_args(argv[1:])
+
+    with open(args.schema) as f:
+        schema = json.load(f)
+    if args.output is None:
+        generate(schema, sys.stdout)
+    else:
+        out = io.BytesIO()
+        generate(schema, out)
+        fragment_cache.write_if_changed(args.output, out.getvalue())
+
+if __name__ == '__main__':
+    main(sys.argv)
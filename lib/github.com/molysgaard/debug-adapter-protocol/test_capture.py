@@ -0,0 +1,120 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import capture
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# answers every request with success, and the commands given on its command
+# line with failure
+stub_adapter = '''\
+import json
+import sys
+
+sys.path.insert(0, {here!r})
+import capture
+
+failing = set(sys.argv[1:])
+seq = 0
+while True:
+    payload = capture.read_frame(sys.stdin.buffer)
+    if payload is None:
+        break
+    msg = json.loads(payload)
+    seq += 1
+    ok = msg['command'] not in failing
+    response = {{'seq': seq, 'type': 'response', 'request_seq': msg['seq'], 'success': ok,
+                'command': msg['command'], 'body': {{'echo': msg.get('arguments')}}}}
+    sys.stdout.buffer.write(capture.frame(json.dumps(response).encode('utf-8')))
+    sys.stdout.buffer.flush()
+'''
+
+
+@pytest.fixture
+def adapter(tmp_path):
+    path = tmp_path / 'stub_adapter.py'
+    path.write_text(stub_adapter.format(here=here))
+    return [sys.executable, str(path)]
+
+
+def request(seq, command, arguments=None):
+    return capture.frame('{{"seq":{},"type":"request","command":"{}","arguments":{}}}'.format(
+        seq, command, 'null' if arguments is None else arguments).encode('utf-8'))
+
+
+@pytest.fixture
+def recorded(tmp_path, adapter):
+    path = str(tmp_path / 'session.dapcap')
+    session = request(1, 'initialize', '{"adapterID":"sml"}') + request(2, 'threads') + request(3, 'scopes', '{"frameId":1}')
+    out = subprocess.run([sys.executable, os.path.join(here, 'capture.py'), 'record', path, '--'] + adapter,
+                         input=session, stdout=subprocess.PIPE, check=True, timeout=60).stdout
+    assert out.count(b'Content-Length') == 3
+    return path
+
+
+def test_record(recorded):
+    c = capture.Capture(recorded)
+    try:
+        entries = list(c.select())
+        assert [(e.direction, e.kind, e.command) for e in entries if e.direction == capture.TO_ADAPTER] == [
+            (capture.TO_ADAPTER, 'request', 'initialize'),
+            (capture.TO_ADAPTER, 'request', 'threads'),
+            (capture.TO_ADAPTER, 'request', 'scopes'),
+        ]
+        responses = [e for e in entries if e.direction == capture.FROM_ADAPTER]
+        assert sorted(e.request_seq for e in responses) == [1, 2, 3]
+        assert all(e.kind == 'response' and e.session == 0 for e in responses)
+        assert c.message(next(c.select(command='scopes', direction=capture.TO_ADAPTER)))['arguments'] == {'frameId': 1}
+    finally:
+        c.close()
+
+
+def test_record_appends_a_session(recorded, adapter):
+    subprocess.run([sys.executable, os.path.join(here, 'capture.py'), 'record', recorded, '--'] + adapter,
+                   input=request(1, 'threads'), stdout=subprocess.PIPE, check=True, timeout=60)
+    c = capture.Capture(recorded)
+    try:
+        assert len(c) == 8
+        assert [e.command for e in c.select(session=1)] == ['threads', 'threads']
+    finally:
+        c.close()
+
+
+def test_show(recorded, capsys):
+    assert capture.main(['capture.py', 'show', recorded, '--command', 'scopes', '--payload']) is None
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 4
+    assert lines[0].split()[3:] == ['>', 'request', '3', '0', 'scopes']
+    assert '"frameId":1' in lines[1]
+    assert lines[2].split()[3:] == ['<', 'response', '3', '3', 'scopes']
+
+
+def test_replay_same(recorded, adapter, capsys):
+    assert capture.main(['capture.py', 'replay', recorded, '--'] + adapter) == 0
+    assert 'session 0: 3 requests, 3 same, 0 differ' in capsys.readouterr().out
+
+
+def test_replay_differs(recorded, adapter, capsys):
+    # options of the adapter after -- are not taken for replay's own
+    assert capture.main(['capture.py', 'replay', recorded, '--realtime', '--', adapter[0], adapter[1], 'scopes']) == 1
+    out = capsys.readouterr().out
+    assert '/success: true -> false' in out
+    assert '3 requests, 2 same, 1 differ' in out
+
+
+@pytest.mark.parametrize('options', [['--command', 'scopes', '{}'], ['{}', '--command', 'scopes']],
+                         ids=['options-first', 'options-last'])
+def test_replay_options_anywhere(recorded, adapter, capsys, options):
+    argv = ['capture.py', 'replay'] + [o.format(recorded) for o in options] + ['--'] + adapter
+    assert capture.main(argv) == 0
+    assert 'session 0: 1 requests, 1 same' in capsys.readouterr().out
+
+
+def test_record_needs_the_adapter(tmp_path, capsys):
+    with pytest.raises(SystemExit) as info:
+        capture.main(['capture.py', 'record', str(tmp_path / 'x.dapcap')])
+    assert info.value.code == 2
+    assert 'after --' in capsys.readouterr().err
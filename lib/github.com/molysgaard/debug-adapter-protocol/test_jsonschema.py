@@ -0,0 +1,98 @@
+import copy
+import io
+import json
+import os
+import re
+
+import pytest
+
+import jsonschema_test as gen
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope='module')
+def schema():
+    with open(os.path.join(here, 'debugProtocol.json')) as f:
+        return json.load(f)
+
+
+def generate(schema, **options):
+    out = io.BytesIO()
+    gen.generate(schema, out, gen.Options(**options))
+    return out.getvalue()
+
+
+def structures(sml):
+    return set(re.findall(rb'^structure (\w+) = struct', sml, re.M))
+
+
+def test_cache_output_is_identical(schema, tmp_path):
+    plain = generate(schema)
+    cache_dir = str(tmp_path / 'cache')
+    # cold, then every fragment from the cache
+    assert generate(schema, cache_dir=cache_dir) == plain
+    assert generate(schema, cache_dir=cache_dir) == plain
+
+    # the warm run did take its fragments from the cache
+    path = os.path.join(cache_dir, 'fragments.json')
+    with open(path) as f:
+        fragments = json.load(f)
+    key = sorted(fragments)[0]
+    fragments[key] += '(* from the cache *)\n'
+    with open(path, 'w') as f:
+        json.dump(fragments, f)
+    assert b'(* from the cache *)' in generate(schema, cache_dir=cache_dir)
+
+
+def test_cache_after_a_schema_change(schema, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    generate(schema, cache_dir=cache_dir)
+    changed = copy.deepcopy(schema)
+    definitions = changed['definitions']
+    definitions['Thread']['description'] = 'A thread, with a new description.'
+    definitions['StackFrame']['properties']['extra'] = {'type': 'integer', 'description': 'A new field.'}
+    del definitions['Breakpoint']['properties']['message']
+    assert generate(changed, cache_dir=cache_dir) == generate(changed)
+    # and back
+    assert generate(schema, cache_dir=cache_dir) == generate(schema)
+
+
+def test_cache_with_pruning(schema, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    generate(schema, cache_dir=cache_dir)
+    options = dict(commands=['initialize', 'threads'], events=['output'])
+    assert generate(schema, cache_dir=cache_dir, **options) == generate(schema, **options)
+
+
+def test_commands_prune(schema):
+    full = generate(schema)
+    pruned = generate(schema, commands=['initialize', 'threads'])
+    assert len(pruned) < len(full) // 2
+    assert structures(pruned) < structures(full)
+    for name in [b'InitializeRequest', b'InitializeResponse', b'Capabilities', b'ThreadsResponse', b'Thread']:
+        assert name in structures(pruned)
+    for name in [b'LaunchRequest', b'StackTraceArguments', b'StackFrame', b'OutputEvent']:
+        assert name not in structures(pruned)
+    handlers = set(re.findall(rb'val handle(\w+) : Cancel.token -> \w+Request\.', pruned))
+    assert handlers == {b'Initialize', b'Threads'}
+    assert b'sendOutputEvent' not in pruned
+
+
+def test_events_prune(schema):
+    pruned = generate(schema, commands=[], events=['output', 'stopped'])
+    assert set(re.findall(rb'fun send(\w+)Event', pruned)) == {b'Output', b'Stopped'}
+    assert b'OutputEvent' in structures(pruned)
+    assert not re.findall(rb'val handle(\w+) : Cancel.token -> \w+Request\.', pruned)
+
+
+def test_unknown_command(schema):
+    with pytest.raises(gen.UnknownRootException) as info:
+        generate(schema, commands=['initialize', 'frobnicate'])
+    assert str(info.value) == 'No command named frobnicate in the schema'
+
+
+def test_runtime_structure_names_are_reserved(schema):
+    # the schema's own Event is left out by default, it would shadow the runtime's
+    with pytest.raises(gen.ReservedNameException):
+        generate(schema, ignored=[n for n in gen.ignored_schems if n != 'Event'])
@@ -0,0 +1,77 @@
+import io
+import json
+import os
+import types
+
+import pytest
+
+import python_codec
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope='module')
+def codec():
+    with open(os.path.join(here, 'debugProtocol.json')) as f:
+        schema = json.load(f)
+    out = io.StringIO()
+    python_codec.generate(schema, out)
+    module = types.ModuleType('dap_codec')
+    exec(compile(out.getvalue(), 'dap_codec.py', 'exec'), module.__dict__)
+    return module
+
+
+messages = [
+    {'seq': 1, 'type': 'request', 'command': 'initialize',
+     'arguments': {'adapterID': 'sml', 'clientID': 'vscode', 'linesStartAt1': True, 'pathFormat': 'path'}},
+    {'seq': 2, 'type': 'request', 'command': 'setBreakpoints',
+     'arguments': {'source': {'path': '/src/a.sml'}, 'breakpoints': [{'line': 3}, {'line': 7, 'condition': 'x > 1'}]}},
+    {'seq': 3, 'type': 'response', 'request_seq': 2, 'success': True, 'command': 'stackTrace',
+     'body': {'stackFrames': [{'id': 1, 'name': 'main', 'line': 3, 'column': 1, 'source': {'name': 'a.sml'}}],
+              'totalFrames': 1}},
+    {'seq': 4, 'type': 'response', 'request_seq': 3, 'success': True, 'command': 'readMemory',
+     'body': {'address': '0x1000', 'data': 'AAECAwQ=', 'unreadableBytes': 3}},
+    {'seq': 5, 'type': 'event', 'event': 'output', 'body': {'category': 'stdout', 'output': 'hello\n'}},
+]
+
+
+@pytest.mark.parametrize('message', messages, ids=lambda m: m.get('command', m.get('event')))
+def test_round_trip(codec, message):
+    decoded = codec.from_message(message)
+    assert not isinstance(decoded, dict)
+    assert decoded.to_dict() == message
+
+
+def test_bytes_are_decoded(codec):
+    response = codec.from_message(messages[3])
+    assert response.body.data == b'\x00\x01\x02\x03\x04'
+    assert response.body.unreadableBytes == 3
+
+
+def test_records_compare_by_value(codec):
+    assert codec.from_message(messages[2]) == codec.from_message(json.loads(json.dumps(messages[2])))
+    assert codec.from_message(messages[2]) != codec.from_message(messages[3])
+
+
+def test_failed_response_without_body(codec):
+    message = {'seq': 6, 'type': 'response', 'request_seq': 5, 'success': False, 'command': 'scopes',
+               'message': 'no frame'}
+    decoded = codec.from_message(message)
+    assert type(decoded).__name__ == 'ErrorResponse'
+    assert decoded.body is None
+    assert decoded.to_dict() == message
+
+
+def test_successful_response_without_body(codec):
+    # the schema requires it, clients do not always send it
+    message = {'seq': 7, 'type': 'response', 'request_seq': 6, 'success': True, 'command': 'threads'}
+    decoded = codec.from_message(message)
+    assert decoded.body is None
+    assert decoded.to_dict() == message
+
+
+def test_unknown_messages_are_left_alone(codec):
+    for message in [{'seq': 8, 'type': 'request', 'command': 'custom'},
+                    {'seq': 9, 'type': 'event', 'event': 'custom'},
+                    {'seq': 10, 'type': 'other'}]:
+        assert codec.from_message(message) is message
@@ -0,0 +1,93 @@
+import io
+import json
+import os
+import types
+
+import pytest
+
+import python_validator
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope='module')
+def validator():
+    with open(os.path.join(here, 'debugProtocol.json')) as f:
+        schema = json.load(f)
+    out = io.StringIO()
+    python_validator.generate(schema, out)
+    module = types.ModuleType('dap_validator')
+    exec(compile(out.getvalue(), 'dap_validator.py', 'exec'), module.__dict__)
+    return module
+
+
+def errors(validator, message):
+    return [(e.path, e.message) for e in validator.validate_all(message)]
+
+
+def request(command, arguments=None, seq=1):
+    message = {'seq': seq, 'type': 'request', 'command': command}
+    if arguments is not None:
+        message['arguments'] = arguments
+    return message
+
+
+valid = [
+    request('initialize', {'adapterID': 'sml', 'pathFormat': 'path', 'linesStartAt1': True}),
+    request('setBreakpoints', {'source': {'path': '/src/a.sml'}, 'breakpoints': [{'line': 3}]}),
+    request('next', {'threadId': 1, 'granularity': 'line'}),
+    request('custom', {'anything': [1, 2]}),
+    {'seq': 2, 'type': 'response', 'request_seq': 1, 'success': False, 'command': 'scopes', 'message': 'no frame',
+     'body': {}},
+    {'seq': 3, 'type': 'event', 'event': 'output', 'body': {'output': 'hi', 'category': 'custom'}},
+]
+
+
+@pytest.mark.parametrize('message', valid, ids=lambda m: m.get('command', m.get('event')))
+def test_valid(validator, message):
+    validator.validate(message)
+    assert validator.validate_all(message) == []
+
+
+def test_not_an_object(validator):
+    assert errors(validator, []) == [('/', 'expected an object')]
+
+
+def test_missing_required(validator):
+    assert errors(validator, request('initialize')) == [('/arguments', 'missing required property')]
+    assert errors(validator, {'type': 'request', 'command': 'custom'}) == [('/seq', 'missing required property')]
+    assert errors(validator, request('initialize', {})) == [('/arguments/adapterID', 'missing required property')]
+
+
+def test_wrong_types(validator):
+    assert errors(validator, request('next', {'threadId': '1'}, seq='1')) == [
+        ('/seq', 'expected an integer'),
+        ('/arguments/threadId', 'expected an integer'),
+    ]
+
+
+def test_closed_enum(validator):
+    assert errors(validator, request('next', {'threadId': 1, 'granularity': 'word'})) == [
+        ('/arguments/granularity', 'expected one of statement, line, instruction'),
+    ]
+
+
+def test_array_elements(validator):
+    message = request('setBreakpoints', {'source': {}, 'breakpoints': [{'line': 3}, {'line': 'x'}, {}]})
+    assert errors(validator, message) == [
+        ('/arguments/breakpoints/1/line', 'expected an integer'),
+        ('/arguments/breakpoints/2/line', 'missing required property'),
+    ]
+
+
+def test_failed_response_is_checked_as_error_response(validator):
+    message = {'seq': 2, 'type': 'response', 'request_seq': 1, 'success': False, 'command': 'stackTrace',
+               'body': {'error': {'id': 'x', 'format': 'no frames'}}}
+    assert errors(validator, message) == [('/body/error/id', 'expected an integer')]
+
+
+def test_validate_raises_the_first_error(validator):
+    with pytest.raises(validator.ValidationError) as info:
+        validator.validate(request('next', {'threadId': '1'}, seq='1'))
+    assert (info.value.path, info.value.message) == ('/seq', 'expected an integer')
+    assert str(info.value) == '/seq: expected an integer'